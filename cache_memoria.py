@@ -0,0 +1,149 @@
+"""
+Cachés en memoria con política LRU (y opcionalmente un nivel compartido
+en MongoDB con TTL).
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+# Marca para distinguir "no está en caché" de un valor None guardado
+NO_ENCONTRADO = object()
+
+
+class CacheLRU:
+    """
+    Caché LRU acotado y thread-safe, con TTL opcional por entrada.
+    Cuenta hits, misses y evictions.
+    """
+
+    def __init__(self, max_items=1000, ttl_segundos=None):
+        self.max_items = max_items
+        self.ttl_segundos = ttl_segundos
+
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # clave -> (expira, valor)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def obtener(self, clave):
+        """Retorna el valor o NO_ENCONTRADO"""
+        with self._lock:
+            item = self._items.get(clave)
+            if item is None or (item[0] and item[0] < time.time()):
+                if item is not None:
+                    del self._items[clave]
+                self.misses += 1
+                return NO_ENCONTRADO
+
+            self._items.move_to_end(clave)
+            self.hits += 1
+            return item[1]
+
+    def guardar(self, clave, valor):
+        expira = time.time() + self.ttl_segundos if self.ttl_segundos else 0
+        with self._lock:
+            self._items[clave] = (expira, valor)
+            self._items.move_to_end(clave)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def limpiar(self):
+        with self._lock:
+            self._items.clear()
+
+    def metricas(self):
+        with self._lock:
+            consultas = self.hits + self.misses
+            return {
+                'items': len(self._items),
+                'max_items': self.max_items,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / consultas if consultas else 0
+            }
+
+
+class CacheCompartido:
+    """
+    Caché de dos niveles: LRU en memoria adelante y una colección de
+    MongoDB con índice TTL atrás, compartida entre procesos y reinicios.
+    Si `obtener_coleccion` devuelve None, funciona solo en memoria.
+    """
+
+    def __init__(self,
+                 obtener_coleccion,
+                 max_items=5000,
+                 ttl_segundos=7 * 24 * 60 * 60):
+        self.obtener_coleccion = obtener_coleccion
+        self.ttl_segundos = ttl_segundos
+        self.memoria = CacheLRU(max_items, ttl_segundos)
+
+        self._indice_creado = False
+        self.hits_mongo = 0
+        self.misses_mongo = 0
+
+    @staticmethod
+    def clave(*partes):
+        """Clave estable (sha1) a partir de las partes"""
+        return hashlib.sha1('\x00'.join(partes).encode('utf-8')).hexdigest()
+
+    def _coleccion(self):
+        coleccion = self.obtener_coleccion()
+        if coleccion is not None and not self._indice_creado:
+            try:
+                coleccion.create_index('creado',
+                                       expireAfterSeconds=self.ttl_segundos)
+            except Exception as e:
+                print(f'ℹ️ Índice TTL de caché: {e}')
+            self._indice_creado = True
+        return coleccion
+
+    def obtener(self, clave):
+        """Retorna el valor o NO_ENCONTRADO"""
+        valor = self.memoria.obtener(clave)
+        if valor is not NO_ENCONTRADO:
+            return valor
+
+        try:
+            coleccion = self._coleccion()
+            if coleccion is None:
+                return NO_ENCONTRADO
+
+            doc = coleccion.find_one({'_id': clave}, {'valor': 1})
+            if doc is None:
+                self.misses_mongo += 1
+                return NO_ENCONTRADO
+
+            self.hits_mongo += 1
+            self.memoria.guardar(clave, doc['valor'])
+            return doc['valor']
+
+        except Exception as e:
+            print(f'⚠️ Error leyendo caché compartido: {e}')
+            return NO_ENCONTRADO
+
+    def guardar(self, clave, valor):
+        self.memoria.guardar(clave, valor)
+
+        try:
+            coleccion = self._coleccion()
+            if coleccion is not None:
+                coleccion.replace_one({'_id': clave}, {
+                    'valor': valor,
+                    'creado': datetime.utcnow()
+                },
+                                      upsert=True)
+        except Exception as e:
+            print(f'⚠️ Error guardando en caché compartido: {e}')
+
+    def metricas(self):
+        datos = self.memoria.metricas()
+        datos['hits_mongo'] = self.hits_mongo
+        datos['misses_mongo'] = self.misses_mongo
+        return datos
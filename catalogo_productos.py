@@ -0,0 +1,957 @@
+"""
+Índice invertido del catálogo de productos, en memoria.
+Se arma al sincronizar (o al arrancar, desde MongoDB) y se publica
+de una sola vez, con un número de generación: las búsquedas nunca ven
+un índice a medio armar. MongoDB sigue siendo la fuente de verdad.
+"""
+
+import heapq
+import math
+import re
+import threading
+import time
+from datetime import datetime
+
+from pymongo import ReturnDocument
+
+# Campos del documento de productos_cache que se buscan ("contiene")
+CAMPOS_BUSQUEDA = ('nombre_lower', 'codigo_lower', 'marca_lower')
+
+# Campos que se leen de productos_cache (proyección: sin descripción,
+# imagen ni fechas de sincronización)
+PROYECCION_CATALOGO = {
+    '_id': 0,
+    'nombre': 1,
+    'nombre_lower': 1,
+    'codigo': 1,
+    'codigo_lower': 1,
+    'marca': 1,
+    'marca_lower': 1,
+    'precio_usd': 1,
+    'stock': 1,
+    'iva': 1,
+    'categoria': 1,
+    'facetas': 1
+}
+
+TAMANO_NGRAMA = 3
+
+# Palabras cuyo conjunto de productos se recuerda por índice
+MAX_PALABRAS_MEMORIZADAS = 5000
+
+
+# Puntaje de relevancia (BM25 sobre el nombre + bonus por código y marca)
+BM25_K1 = 1.2
+BM25_B = 0.75
+PESO_PARCIAL = 0.5  # la palabra es parte de un token, no el token entero
+PESO_CODIGO_EXACTO = 10.0
+PESO_CODIGO_PARCIAL = 4.0
+PESO_MARCA = 2.0
+
+# Búsqueda tolerante a errores de tipeo: largo mínimo de la palabra
+# para corregirla (con 1 error: letra cambiada, de más, de menos o
+# dos letras invertidas)
+LARGO_MINIMO_CORRECCION = 4
+
+
+# ============== FACETAS ==============
+
+# Tipo de producto: el que aparece primero en el nombre
+TIPOS_PRODUCTO = ('camara', 'dvr', 'nvr', 'xvr', 'sensor', 'alarma', 'kit',
+                  'hub', 'teclado', 'sirena', 'disco', 'fuente', 'switch',
+                  'cable', 'balun')
+FORMAS_CAMARA = ('domo', 'bullet', 'ptz', 'turret', 'cubo', 'fisheye')
+MARCAS_CONOCIDAS = ('hikvision', 'dahua', 'ajax', 'dsc', 'intelbras',
+                    'ubiquiti', 'tiandy', 'cygnus', 'zkteco')
+
+# Accesorios: si el nombre empieza así, no es una cámara aunque diga "domo"
+PALABRAS_ACCESORIO = ('soporte', 'caja', 'fuente', 'balun', 'cable',
+                      'conector', 'ficha', 'brazo', 'carcasa', 'gabinete',
+                      'adaptador', 'transformador', 'bracket', 'montaje',
+                      'base')
+
+PATRON_TIPO = re.compile(r'\b(c[aá]mara|' + '|'.join(TIPOS_PRODUCTO[1:]) +
+                         r')(?:e?s)?\b')
+PATRON_FORMA = re.compile(r'\b(?:mini)?(' + '|'.join(FORMAS_CAMARA) + r')s?\b')
+PATRON_ACCESORIO = re.compile(r'^\W*(' + '|'.join(PALABRAS_ACCESORIO) +
+                              r')(?:e?s)?\b')
+# Lo que viene después de "para" describe con qué se usa, no qué es
+PATRON_PARA = re.compile(r'\bpara\b')
+PATRON_RESOLUCION = re.compile(r'(\d+(?:[.,]\d+)?)\s*mp\b')
+PATRON_RESOLUCION_ALIAS = re.compile(r'\b(1080p?|2k|4k)\b')
+RESOLUCION_ALIAS = {'1080': 2, '1080p': 2, '2k': 4, '4k': 8}
+PATRON_CANALES = re.compile(r'\b(\d+)\s*(?:ch|can|canales|canal)\b')
+PATRON_ALMACENAMIENTO = re.compile(r'\b(\d+(?:[.,]\d+)?)\s*(tb|gb)\b')
+PATRON_UBICACION = re.compile(r'\b(interior|exterior|indoor|outdoor)\b')
+PATRON_TECNOLOGIA = re.compile(
+    r'\b(ip|wi-?fi|hd-?tvi|turbo\s*hd|hd-?cvi|ahd|analogica|poe)\b')
+TECNOLOGIA_CANONICA = {
+    'wifi': 'wifi', 'wi-fi': 'wifi', 'hdtvi': 'hdtvi', 'hd-tvi': 'hdtvi',
+    'turbohd': 'hdtvi', 'hdcvi': 'hdcvi', 'hd-cvi': 'hdcvi', 'ahd': 'ahd',
+    'analogica': 'ahd', 'ip': 'ip', 'poe': 'ip'
+}
+
+# Facetas con índice (en memoria y en MongoDB)
+CAMPOS_FACETA = ('tipo', 'forma', 'marca', 'resolucion_mp', 'canales',
+                 'almacenamiento_gb', 'tecnologia', 'ubicacion')
+
+
+def _numero(texto):
+    valor = float(texto.replace(',', '.'))
+    return int(valor) if valor.is_integer() else valor
+
+
+def extraer_facetas(nombre, marca=''):
+    """
+    Atributos de un producto a partir de su nombre (y marca).
+    También sirve para un término de búsqueda ("domo hikvision 4mp").
+    Los que no aparecen quedan en None.
+    """
+    texto = (nombre or '').lower()
+    marca = (marca or '').lower().strip()
+
+    tipo = None
+    forma = None
+    accesorio = PATRON_ACCESORIO.match(texto)
+    if accesorio:
+        # "Soporte para cámara domo": sin forma, y tipo solo si el
+        # accesorio es un tipo propio (fuente, balun, cable)
+        if accesorio.group(1) in TIPOS_PRODUCTO:
+            tipo = accesorio.group(1)
+    else:
+        para = PATRON_PARA.search(texto)
+        propio = texto[:para.start()] if para else texto
+
+        match = PATRON_TIPO.search(propio)
+        if match:
+            tipo = match.group(1).replace('á', 'a')
+
+        match = PATRON_FORMA.search(propio)
+        if match:
+            forma = match.group(1)
+            tipo = tipo or 'camara'
+
+    resolucion = None
+    match = PATRON_RESOLUCION.search(texto)
+    if match:
+        resolucion = _numero(match.group(1))
+    else:
+        match = PATRON_RESOLUCION_ALIAS.search(texto)
+        if match:
+            resolucion = RESOLUCION_ALIAS[match.group(1)]
+
+    canales = None
+    match = PATRON_CANALES.search(texto)
+    if match:
+        canales = int(match.group(1))
+
+    almacenamiento = None
+    match = PATRON_ALMACENAMIENTO.search(texto)
+    if match:
+        almacenamiento = _numero(match.group(1))
+        if match.group(2) == 'tb':
+            almacenamiento = _numero(str(almacenamiento * 1000))
+
+    tecnologia = None
+    match = PATRON_TECNOLOGIA.search(texto)
+    if match:
+        tecnologia = TECNOLOGIA_CANONICA.get(
+            re.sub(r'\s+', '', match.group(1)), match.group(1))
+
+    ubicacion = None
+    match = PATRON_UBICACION.search(texto)
+    if match:
+        ubicacion = 'interior' if match.group(1) in ('interior',
+                                                     'indoor') else 'exterior'
+
+    if not marca:
+        marca = next((m for m in MARCAS_CONOCIDAS if m in texto), None)
+
+    return {
+        'tipo': tipo,
+        'forma': forma,
+        'marca': marca or None,
+        'resolucion_mp': resolucion,
+        'canales': canales,
+        'almacenamiento_gb': almacenamiento,
+        'tecnologia': tecnologia,
+        'ubicacion': ubicacion
+    }
+
+
+def similitud_alternativa(pedidas, facetas):
+    """Similitud entre las facetas pedidas y las de un producto alternativo"""
+    puntuacion = 0
+
+    # Bonus por misma marca
+    if pedidas.get('marca') and facetas.get('marca') == pedidas['marca']:
+        puntuacion += 10
+
+    # Bonus por mismo tipo, y un poco más si además es la misma forma
+    if pedidas.get('tipo') and facetas.get('tipo') == pedidas['tipo']:
+        puntuacion += 5
+    if pedidas.get('forma') and facetas.get('forma') == pedidas['forma']:
+        puntuacion += 3
+
+    # Bonus por resolución cercana
+    resolucion_pedida = pedidas.get('resolucion_mp')
+    res_alt = facetas.get('resolucion_mp')
+    if resolucion_pedida and res_alt:
+        # Priorizar resolución más cercana (preferir mayor)
+        diff = abs(res_alt - resolucion_pedida)
+        if res_alt >= resolucion_pedida:
+            puntuacion += max(0, 10 - diff)
+        else:
+            puntuacion += max(0, 5 - diff)
+
+    return puntuacion
+
+
+# Facetas que definen qué tan buena es una alternativa
+CAMPOS_SIMILITUD = ('tipo', 'marca', 'forma', 'resolucion_mp')
+
+# Alternativas precalculadas por producto (y por combinación de facetas)
+ALTERNATIVAS_POR_PRODUCTO = 5
+
+
+# ============== PRODUCTO ==============
+
+
+class ProductoCatalogo:
+    """
+    Producto del catálogo con un solo juego de campos (__slots__, sin dict
+    por instancia). Se lee como los dicts que usa Ovidio: p.get('name'),
+    p['precio'], p.get('sku')... los nombres viejos son alias de los
+    campos canónicos.
+    """
+
+    __slots__ = ('nombre', 'codigo', 'marca', 'precio', 'stock', 'iva',
+                 'categoria', 'facetas', 'variante')
+
+    ALIAS = {
+        'name': 'nombre',
+        'price': 'precio',
+        'precio_usd': 'precio',
+        'sku': 'codigo',
+        'cantidad': 'stock'
+    }
+
+    def __init__(self, nombre='', codigo='', marca='', precio=0, stock=0,
+                 iva=21, categoria='', facetas=None, variante=None):
+        self.nombre = nombre
+        self.codigo = codigo
+        self.marca = marca
+        self.precio = precio
+        self.stock = stock
+        self.iva = iva
+        self.categoria = categoria
+        self.facetas = facetas or {}
+        self.variante = variante
+
+    @classmethod
+    def desde_documento(cls, doc):
+        """Documento de productos_cache → ProductoCatalogo"""
+        return cls(nombre=doc.get('nombre') or '',
+                   codigo=doc.get('codigo') or '',
+                   marca=doc.get('marca') or '',
+                   precio=doc.get('precio_usd') or 0,
+                   stock=doc.get('stock') or 0,
+                   iva=doc.get('iva', 21),
+                   categoria=doc.get('categoria') or '',
+                   facetas=doc.get('facetas'),
+                   variante=doc.get('variante'))
+
+    def copiar(self, **cambios):
+        copia = ProductoCatalogo.__new__(ProductoCatalogo)
+        for campo in self.__slots__:
+            setattr(copia, campo, cambios.get(campo, getattr(self, campo)))
+        return copia
+
+    def _campo(self, clave):
+        campo = self.ALIAS.get(clave, clave)
+        if campo not in self.__slots__:
+            raise KeyError(clave)
+        return campo
+
+    def get(self, clave, defecto=None):
+        try:
+            return getattr(self, self._campo(clave))
+        except KeyError:
+            return defecto
+
+    def __getitem__(self, clave):
+        return getattr(self, self._campo(clave))
+
+    def __setitem__(self, clave, valor):
+        setattr(self, self._campo(clave), valor)
+
+    def __contains__(self, clave):
+        return self.ALIAS.get(clave, clave) in self.__slots__
+
+    def a_dict(self):
+        """Formato dict completo (con los nombres viejos), ej: para JSON"""
+        return {
+            'name': self.nombre,
+            'nombre': self.nombre,
+            'price': self.precio,
+            'precio': self.precio,
+            'stock': self.stock,
+            'cantidad': self.stock,
+            'sku': self.codigo,
+            'codigo': self.codigo,
+            'iva': self.iva,
+            'marca': self.marca,
+            'categoria': self.categoria,
+            'facetas': self.facetas,
+            'variante': self.variante
+        }
+
+    def __repr__(self):
+        return f'ProductoCatalogo({self.codigo!r}, {self.nombre!r}, stock={self.stock})'
+
+
+# ============== ÍNDICE ==============
+
+
+def _ngramas(palabra, n=TAMANO_NGRAMA):
+    return {palabra[i:i + n] for i in range(len(palabra) - n + 1)}
+
+
+def _borrados(palabra):
+    """La palabra sin cada una de sus letras ('dahua' -> 'ahua', 'dhua', ...)"""
+    return {palabra[:i] + palabra[i + 1:] for i in range(len(palabra))}
+
+
+def prefijo_modelo(codigo):
+    """
+    Modelo de un código sin la variante: los dos primeros segmentos
+    ('ds-2ce16d0t-irpf' -> 'ds-2ce16d0t'). Sin segmentos, el código entero.
+    """
+    return '-'.join(re.split(r'[-/]', codigo.lower())[:2])
+
+
+def mismo_modelo(modelo, otro):
+    """
+    True si `otro` es otra variante del mismo producto: mismo prefijo de
+    código o un nombre contenido en el otro. No se ofrece como alternativa.
+    Recibe pares (prefijo_modelo, nombre en minúsculas).
+    """
+    prefijo, nombre = modelo
+    prefijo_otro, nombre_otro = otro
+    if prefijo and prefijo == prefijo_otro:
+        return True
+    return bool(nombre and nombre_otro) and (nombre in nombre_otro
+                                             or nombre_otro in nombre)
+
+
+def compactar_codigo(token):
+    """'ds-2ce16d0t' -> 'ds2ce16d0t' (los clientes escriben los códigos sin guiones)"""
+    return token.replace('-', '').replace('.', '').replace('/', '')
+
+
+def distancia_edicion(a, b, maximo):
+    """
+    Distancia de edición entre `a` y `b`, contando como un error una
+    letra cambiada, de más, de menos, o dos letras invertidas.
+    Corta apenas supera `maximo` (retorna maximo + 1).
+    """
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+
+    anteanterior = None
+    anterior = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        actual = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            costo = a[i - 1] != b[j - 1]
+            actual[j] = min(anterior[j] + 1, actual[j - 1] + 1,
+                            anterior[j - 1] + costo)
+            if (anteanterior is not None and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                actual[j] = min(actual[j], anteanterior[j - 2] + 1)
+        if min(actual) > maximo:
+            return maximo + 1
+        anteanterior, anterior = anterior, actual
+    return anterior[-1]
+
+
+class IndiceCatalogo:
+    """
+    Índice de tokens y trigramas sobre nombre, código y marca.
+
+    - tokens: token -> ids de productos que lo contienen
+    - ngramas: trigrama (o substring de 1-2 letras) -> tokens que lo contienen
+    - borrados: token y token sin una letra -> tokens (corrección de tipeo
+      por borrado simétrico: dos palabras a 1 error comparten un borrado)
+    - facetas: (faceta, valor) -> ids de productos (tipo, marca, resolución...)
+    - alternativas: id -> mejores productos CON stock del mismo tipo
+
+    Una palabra de búsqueda matchea un producto si es substring de alguno
+    de sus campos (misma semántica que el $regex que reemplaza). Como la
+    palabra no tiene espacios, eso equivale a ser substring de alguno de
+    sus tokens: se buscan los tokens candidatos por trigramas, se
+    verifican, y se unen sus productos.
+    """
+
+    def __init__(self, productos):
+        inicio = time.time()
+        self.productos = []
+        self.tokens = {}
+        self.ngramas = {}
+        self._memoria = {}  # palabra -> ids (el índice no cambia)
+        self.generacion = 0
+        self._nombres = []  # pid -> tokens del nombre
+        self._codigos = []  # pid -> (código, código sin guiones)
+        self._marcas = []  # pid -> tokens de la marca
+        self._modelos = []  # pid -> (prefijo del código, nombre), ver mismo_modelo
+
+        self.facetas = {}
+
+        for doc in productos:
+            pid = len(self.productos)
+            producto = ProductoCatalogo.desde_documento(doc)
+            # Documentos sincronizados antes de que existieran las facetas
+            if not producto.facetas:
+                producto.facetas = extraer_facetas(producto.nombre,
+                                                   producto.marca)
+            self.productos.append(producto)
+
+            for campo, valor in producto.facetas.items():
+                if valor is not None:
+                    self.facetas.setdefault((campo, valor), set()).add(pid)
+
+            # Estadísticas para el puntaje
+            codigo_lower = doc.get('codigo_lower') or ''
+            self._nombres.append(tuple((doc.get('nombre_lower') or '').split()))
+            self._codigos.append((codigo_lower, compactar_codigo(codigo_lower)))
+            self._marcas.append(tuple((doc.get('marca_lower') or '').split()))
+            self._modelos.append((prefijo_modelo(codigo_lower) if codigo_lower
+                                  else '', producto.nombre.lower()))
+
+            for campo in CAMPOS_BUSQUEDA:
+                for token in (doc.get(campo) or '').split():
+                    self.tokens.setdefault(token, set()).add(pid)
+                    # Códigos sin guiones: "ds2ce16" encuentra "ds-2ce16d0t"
+                    compacto = compactar_codigo(token)
+                    if compacto != token and len(compacto) >= LARGO_MINIMO_CORRECCION:
+                        self.tokens.setdefault(compacto, set()).add(pid)
+
+        for token in self.tokens:
+            for n in range(1, TAMANO_NGRAMA + 1):
+                for ngrama in _ngramas(token, n):
+                    self.ngramas.setdefault(ngrama, set()).add(token)
+
+        self.borrados = {}
+        for token in self.tokens:
+            if len(token) >= LARGO_MINIMO_CORRECCION:
+                for borrado in _borrados(token) | {token}:
+                    self.borrados.setdefault(borrado, set()).add(token)
+        self._correcciones = {}  # palabra -> tokens corregidos
+        self._puntajes_memoria = {}  # (palabra, tolerante) -> (ids, puntajes)
+
+        self._por_codigo = {
+            producto.codigo: pid
+            for pid, producto in enumerate(self.productos) if producto.codigo
+        }
+
+        self._largo_promedio = (sum(len(n) for n in self._nombres) /
+                                len(self._nombres)) if self._nombres else 1
+        self._largo_promedio = self._largo_promedio or 1
+
+        # Orden por stock (mayor primero), para búsquedas sin palabras
+        self._orden = sorted(range(len(self.productos)),
+                             key=lambda pid: -self.productos[pid].stock)
+
+        self._calcular_alternativas()
+
+        self.creado = time.time()
+        self.segundos_armado = self.creado - inicio
+
+    def __len__(self):
+        return len(self.productos)
+
+    def _tokens_con(self, palabra):
+        """Tokens del vocabulario que contienen `palabra`"""
+        if len(palabra) <= TAMANO_NGRAMA:
+            return self.ngramas.get(palabra, ())
+
+        candidatos = None
+        for ngrama in _ngramas(palabra):
+            tokens = self.ngramas.get(ngrama)
+            if not tokens:
+                return []
+            candidatos = tokens if candidatos is None else candidatos & tokens
+
+        return [token for token in candidatos if palabra in token]
+
+    def _ids_con(self, palabra):
+        ids = self._memoria.get(palabra)
+        if ids is None:
+            ids = set()
+            for token in self._tokens_con(palabra):
+                ids |= self.tokens[token]
+            ids = frozenset(ids)
+            if len(self._memoria) < MAX_PALABRAS_MEMORIZADAS:
+                self._memoria[palabra] = ids
+        return ids
+
+    def corregir(self, palabra):
+        """
+        Tokens del vocabulario a un error de tipeo de `palabra`
+        (si tiene 4 letras o más). Lista vacía si no hay ninguno.
+        """
+        corregidos = self._correcciones.get(palabra)
+        if corregidos is not None:
+            return corregidos
+
+        corregidos = []
+        if len(palabra) >= LARGO_MINIMO_CORRECCION:
+            candidatos = set()
+            for borrado in _borrados(palabra) | {palabra}:
+                candidatos |= self.borrados.get(borrado, set())
+            corregidos = sorted(
+                token for token in candidatos
+                if distancia_edicion(palabra, token, 1) <= 1)
+            if corregidos:
+                print(f'🔤 Corrección: "{palabra}" → {corregidos[:3]}')
+
+        if len(self._correcciones) < MAX_PALABRAS_MEMORIZADAS:
+            self._correcciones[palabra] = corregidos
+        return corregidos
+
+    def _resolver(self, palabra, tolerante):
+        """
+        (ids, exactos): productos que matchean `palabra` y los tokens que
+        cuentan como coincidencia exacta (la palabra o sus correcciones).
+        """
+        ids = self._ids_con(palabra)
+        if ids or not tolerante:
+            return ids, (palabra, )
+
+        corregidos = self.corregir(palabra)
+        ids = set()
+        for token in corregidos:
+            ids |= self._ids_con(token)
+        return ids, tuple(corregidos)
+
+    def _puntuar(self, palabra, exactos, df, pid):
+        """
+        Aporte de `palabra` al puntaje del producto, desglosado:
+        BM25 sobre el nombre, coincidencia de código y de marca.
+        """
+        nombre = self._nombres[pid]
+        tf = 0.0
+        for token in nombre:
+            if token in exactos:
+                tf += 1
+            elif any(exacto in token for exacto in exactos):
+                tf += PESO_PARCIAL
+
+        idf = math.log(1 + (len(self.productos) - df + 0.5) / (df + 0.5))
+        bm25 = 0.0
+        if tf:
+            largo = len(nombre) / self._largo_promedio
+            bm25 = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 *
+                                                (1 - BM25_B + BM25_B * largo))
+
+        codigo = 0.0
+        codigo_lower, compacto = self._codigos[pid]
+        if codigo_lower:
+            for exacto in exactos:
+                if exacto == codigo_lower or exacto == compacto:
+                    codigo = PESO_CODIGO_EXACTO
+                    break
+                if len(exacto) >= LARGO_MINIMO_CORRECCION and (
+                        exacto in codigo_lower or exacto in compacto):
+                    # Cuanto más largo el pedazo de código, más cuenta
+                    codigo = max(codigo, PESO_CODIGO_PARCIAL * len(exacto) /
+                                 len(compacto or codigo_lower))
+
+        marca = 0.0
+        marca_tokens = self._marcas[pid]
+        if any(exacto in marca_tokens for exacto in exactos):
+            marca = PESO_MARCA
+        elif any(exacto in token for exacto in exactos
+                 for token in marca_tokens):
+            marca = PESO_MARCA * PESO_PARCIAL
+
+        return {
+            'tf': tf,
+            'idf': round(idf, 3),
+            'bm25': round(bm25, 3),
+            'codigo': round(codigo, 3),
+            'marca': marca,
+            'total': bm25 + codigo + marca
+        }
+
+    def _puntajes(self, palabra, tolerante):
+        """(ids, {pid: puntaje}) de una palabra, memorizado por índice"""
+        clave = (palabra, tolerante)
+        memorizado = self._puntajes_memoria.get(clave)
+        if memorizado is not None:
+            return memorizado
+
+        ids, exactos = self._resolver(palabra, tolerante)
+        # Redondeado para que el stock desempate puntajes iguales
+        puntajes = {
+            pid: round(self._puntuar(palabra, exactos, len(ids), pid)['total'],
+                       6)
+            for pid in ids
+        }
+        if len(self._puntajes_memoria) < MAX_PALABRAS_MEMORIZADAS:
+            self._puntajes_memoria[clave] = (ids, puntajes)
+        return ids, puntajes
+
+    def _rankear(self, consulta, limite, tolerante, con_stock=False):
+        """
+        [(pid, puntaje), ...] de mayor a menor; el stock desempata.
+        Con `con_stock`, los productos sin stock se descartan ANTES de
+        cortar en `limite` (si no, los más relevantes sin stock taparían
+        a los que sí hay).
+        """
+        palabras = set(consulta.lower().split())
+        if not palabras:
+            return [(pid, 0.0) for pid in self._orden[:limite]
+                    if not con_stock or self.productos[pid].stock > 0]
+
+        ids = None
+        por_palabra = []
+        # Primero las palabras más largas: dan los conjuntos más chicos
+        for palabra in sorted(palabras, key=len, reverse=True):
+            encontrados, puntajes = self._puntajes(palabra, tolerante)
+            ids = encontrados if ids is None else ids & encontrados
+            if not ids:
+                return []
+            por_palabra.append(puntajes)
+
+        if len(por_palabra) == 1:
+            totales = por_palabra[0]
+        else:
+            totales = {
+                pid: sum(puntajes[pid] for puntajes in por_palabra)
+                for pid in ids
+            }
+        candidatos = totales
+        if con_stock:
+            candidatos = [
+                pid for pid in totales if self.productos[pid].stock > 0
+            ]
+        mejores = heapq.nsmallest(
+            limite,
+            candidatos,
+            key=lambda pid: (-totales[pid], -self.productos[pid].stock))
+        return [(pid, totales[pid]) for pid in mejores]
+
+    def buscar(self, consulta, limite=20, tolerante=False, con_stock=False):
+        """
+        Productos donde TODAS las palabras de `consulta` aparecen en el
+        nombre, código o marca, ordenados por relevancia (BM25 sobre el
+        nombre + código exacto + marca; el stock desempata), hasta `limite`.
+        Con `tolerante`, las palabras que no aparecen se corrigen a la
+        palabra más parecida del catálogo ("hikvsion" → "hikvision").
+        Con `con_stock`, solo productos con stock.
+        """
+        return [
+            self.productos[pid] for pid, _ in self._rankear(
+                consulta, limite, tolerante, con_stock)
+        ]
+
+    def explicar(self, consulta, limite=10, tolerante=True, con_stock=False):
+        """Igual que buscar, con el desglose del puntaje de cada producto"""
+        palabras = set(consulta.lower().split())
+        resueltas = {
+            palabra: self._resolver(palabra, tolerante)
+            for palabra in palabras
+        }
+
+        resultado = []
+        for posicion, (pid, puntaje) in enumerate(
+                self._rankear(consulta, limite, tolerante, con_stock), 1):
+            producto = self.productos[pid]
+            detalle = {}
+            for palabra, (ids, exactos) in resueltas.items():
+                detalle[palabra] = self._puntuar(palabra, exactos, len(ids), pid)
+                detalle[palabra]['total'] = round(detalle[palabra]['total'], 3)
+                if exactos != (palabra, ):
+                    detalle[palabra]['corregida_a'] = list(exactos)
+            resultado.append({
+                'posicion': posicion,
+                'nombre': producto.nombre,
+                'codigo': producto.codigo,
+                'marca': producto.marca,
+                'stock': producto.stock,
+                'puntaje': round(puntaje, 3),
+                'palabras': detalle
+            })
+        return resultado
+
+    def filtrar(self, con_stock=True, **facetas):
+        """
+        Productos con esas facetas (ej: tipo='camara', marca='dahua'),
+        ordenados por stock. Las facetas en None se ignoran.
+        """
+        ids = None
+        for campo, valor in facetas.items():
+            if valor is None:
+                continue
+            encontrados = self.facetas.get((campo, valor), set())
+            ids = encontrados if ids is None else ids & encontrados
+
+        orden = self._orden if ids is None else sorted(
+            ids, key=lambda pid: -self.productos[pid].stock)
+        return [
+            self.productos[pid] for pid in orden
+            if not con_stock or self.productos[pid].stock > 0
+        ]
+
+    # ----- Alternativas -----
+
+    def _calcular_alternativas(self):
+        """
+        Para cada producto con tipo, las mejores alternativas CON stock
+        (sin otras variantes del mismo modelo, ver mismo_modelo).
+        Los productos con stock se agrupan por tipo y, adentro, por
+        (marca, forma, resolución): el ranking se calcula una vez por
+        combinación de facetas, no por producto.
+        """
+        # tipo -> {clave: [ids con stock, de mayor a menor stock]}
+        self._con_stock_por_tipo = {}
+        for pid in self._orden:
+            producto = self.productos[pid]
+            tipo = producto.facetas.get('tipo')
+            if tipo and producto.stock > 0:
+                grupos = self._con_stock_por_tipo.setdefault(tipo, {})
+                grupos.setdefault(self._clave_similitud(producto.facetas),
+                                  []).append(pid)
+
+        self._rankings = {}  # clave de facetas -> ids ordenados
+        self.alternativas = {}
+        for pid, producto in enumerate(self.productos):
+            if producto.facetas.get('tipo'):
+                modelo = self._modelos[pid]
+                alternativas = []
+                for alt in self._ranking_alternativas(producto.facetas):
+                    if alt != pid and not mismo_modelo(modelo,
+                                                       self._modelos[alt]):
+                        alternativas.append(alt)
+                        if len(alternativas) == ALTERNATIVAS_POR_PRODUCTO:
+                            break
+                self.alternativas[pid] = tuple(alternativas)
+
+    @staticmethod
+    def _clave_similitud(facetas):
+        return tuple(facetas.get(campo) for campo in CAMPOS_SIMILITUD)
+
+    def _ranking_alternativas(self, facetas):
+        """
+        Ids CON stock del mismo tipo, de más a menos parecido (a igual
+        puntaje, más stock). Memorizado por combinación de facetas.
+        """
+        clave = self._clave_similitud(facetas)
+        ranking = self._rankings.get(clave)
+        if ranking is not None:
+            return ranking
+
+        grupos = self._con_stock_por_tipo.get(facetas.get('tipo'), {})
+        puntuados = sorted(
+            ((similitud_alternativa(facetas, dict(zip(CAMPOS_SIMILITUD, otra))),
+              ids) for otra, ids in grupos.items()),
+            key=lambda item: -item[0])
+
+        # Grupos en orden de puntaje hasta juntar suficientes (el doble:
+        # se descartan el mismo producto y sus variantes), completando
+        # los empates
+        candidatos = []
+        for puntaje, ids in puntuados:
+            if (len(candidatos) >= 2 * ALTERNATIVAS_POR_PRODUCTO
+                    and puntaje < candidatos[-1][0]):
+                break
+            candidatos.extend((puntaje, pid) for pid in ids)
+
+        candidatos.sort(
+            key=lambda item: (-item[0], -self.productos[item[1]].stock))
+        ranking = tuple(pid for _, pid in candidatos)
+        if len(self._rankings) < MAX_PALABRAS_MEMORIZADAS:
+            self._rankings[clave] = ranking
+        return ranking
+
+    def alternativas_de_producto(self, codigo, cantidad=3):
+        """Alternativas precalculadas del producto con ese código (o None)"""
+        pid = self._por_codigo.get(codigo)
+        if pid is None or pid not in self.alternativas:
+            return None
+        return [self.productos[alt] for alt in self.alternativas[pid][:cantidad]]
+
+    def alternativas_para_facetas(self, facetas, cantidad=3, excluir=''):
+        """
+        Alternativas CON stock para un pedido ("domo hikvision 4mp"),
+        sin productos cuyo nombre contenga `excluir`.
+        """
+        if not facetas.get('tipo'):
+            return []
+
+        excluir = excluir.lower()
+        resultado = []
+        for pid in self._ranking_alternativas(facetas):
+            producto = self.productos[pid]
+            if excluir and excluir in producto.nombre.lower():
+                continue
+            resultado.append(producto)
+            if len(resultado) >= cantidad:
+                break
+        return resultado
+
+    def metricas(self):
+        return {
+            'productos': len(self.productos),
+            'con_alternativas': len(self.alternativas),
+            'facetas': len(self.facetas),
+            'tokens': len(self.tokens),
+            'ngramas': len(self.ngramas),
+            'correcciones_memorizadas': len(self._correcciones),
+            'segundos_armado': round(self.segundos_armado, 3)
+        }
+
+
+class Catalogo:
+    """
+    Índice activo del catálogo y su estado: generación, cantidad de
+    productos y fecha de sincronización. La sincronización publica una
+    generación nueva; las búsquedas leen el estado de memoria, sin
+    consultar MongoDB. El estado se guarda en MongoDB para sobrevivir
+    reinicios.
+    """
+
+    ID_ESTADO = 'productos'
+
+    def __init__(self, obtener_coleccion):
+        self.obtener_coleccion = obtener_coleccion
+        self._lock = threading.Lock()
+        self.indice = None
+        self.estado = None  # {'generacion', 'productos', 'sincronizado'}
+        self._al_publicar = []
+
+    @property
+    def generacion(self):
+        estado = self.estado
+        return estado['generacion'] if estado else 0
+
+    def al_publicar(self, funcion):
+        """Registra `funcion()` para llamarla cada vez que se publica un índice"""
+        self._al_publicar.append(funcion)
+
+    def listo(self):
+        """True si hay catálogo sincronizado (con o sin índice en memoria)"""
+        estado = self.estado
+        return bool(estado and estado['productos'])
+
+    def cargar_estado(self):
+        """Lee el estado guardado en MongoDB (al arrancar)"""
+        try:
+            coleccion = self.obtener_coleccion()
+            if coleccion is None:
+                return None
+            doc = coleccion.find_one({'_id': self.ID_ESTADO})
+            if doc:
+                self.estado = {
+                    'generacion': doc.get('generacion', 0),
+                    'productos': doc.get('productos', 0),
+                    'sincronizado': doc.get('sincronizado')
+                }
+        except Exception as e:
+            print(f'⚠️ Error leyendo estado del catálogo: {e}')
+        return self.estado
+
+    def _nueva_generacion(self, productos, sincronizado):
+        """Incrementa la generación en MongoDB (o en memoria si falla)"""
+        try:
+            coleccion = self.obtener_coleccion()
+            if coleccion is not None:
+                doc = coleccion.find_one_and_update(
+                    {'_id': self.ID_ESTADO}, {
+                        '$inc': {
+                            'generacion': 1
+                        },
+                        '$set': {
+                            'productos': productos,
+                            'sincronizado': sincronizado
+                        }
+                    },
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER)
+                return doc['generacion']
+        except Exception as e:
+            print(f'⚠️ Error guardando estado del catálogo: {e}')
+        return self.generacion + 1
+
+    def publicar(self, indice, sincronizado=None, nueva_generacion=True):
+        """
+        Reemplaza el índice activo (las búsquedas en curso siguen con el
+        viejo). Con `nueva_generacion`, registra una sincronización nueva.
+        """
+        sincronizado = sincronizado or datetime.utcnow()
+        with self._lock:
+            if nueva_generacion or self.estado is None:
+                generacion = self._nueva_generacion(len(indice), sincronizado)
+            else:
+                generacion = self.generacion
+                sincronizado = self.estado['sincronizado'] or sincronizado
+
+            indice.generacion = generacion
+            self.indice = indice
+            self.estado = {
+                'generacion': generacion,
+                'productos': len(indice),
+                'sincronizado': sincronizado
+            }
+
+        print(f'✅ Catálogo generación {generacion} publicado: '
+              f'{len(indice)} productos, {len(indice.tokens)} tokens '
+              f'({indice.segundos_armado:.2f}s)')
+
+        for funcion in self._al_publicar:
+            try:
+                funcion()
+            except Exception as e:
+                print(f'⚠️ Error notificando publicación del catálogo: {e}')
+
+    def marcar_sincronizado(self, sincronizado=None):
+        """
+        Registra una sincronización que no cambió nada: actualiza la
+        fecha sin publicar una generación nueva (el caché sigue valiendo).
+        """
+        sincronizado = sincronizado or datetime.utcnow()
+        with self._lock:
+            if self.estado is None:
+                return
+            self.estado = dict(self.estado, sincronizado=sincronizado)
+
+        try:
+            coleccion = self.obtener_coleccion()
+            if coleccion is not None:
+                coleccion.update_one({'_id': self.ID_ESTADO},
+                                     {'$set': {
+                                         'sincronizado': sincronizado
+                                     }})
+        except Exception as e:
+            print(f'⚠️ Error guardando estado del catálogo: {e}')
+
+    def metricas(self):
+        estado = self.estado
+        if not estado:
+            return {'generacion': 0, 'productos': 0, 'listo': False}
+
+        sincronizado = estado['sincronizado']
+        datos = {
+            'generacion': estado['generacion'],
+            'productos': estado['productos'],
+            'listo': bool(estado['productos']),
+            'sincronizado': sincronizado.isoformat() if sincronizado else None,
+            'antiguedad_segundos':
+            round((datetime.utcnow() - sincronizado).total_seconds())
+            if sincronizado else None,
+            'indice_en_memoria': self.indice is not None
+        }
+        if self.indice is not None:
+            datos['indice'] = self.indice.metricas()
+        return datos
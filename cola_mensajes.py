@@ -0,0 +1,308 @@
+"""
+Cola de mensajes entrantes de WhatsApp.
+El webhook encola y responde al instante; un pool de workers procesa.
+Los mensajes de un mismo remitente se procesan en orden, de a uno,
+y remitentes distintos se procesan en paralelo. Las ráfagas de un mismo
+remitente ("hola" / "tenés cámaras?" / "hikvision 4mp") se agrupan en un turno.
+Los reintentos de Meta se descartan por id de mensaje antes de encolar.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+
+class ColaPorRemitente:
+    """
+    Cola acotada con una sub-cola FIFO por remitente.
+    Un remitente nunca está en dos workers a la vez.
+
+    Con `ventana_segundos` > 0, un remitente recién pasa a los workers
+    cuando lleva esa cantidad de segundos sin mandar nada (o cuando su
+    mensaje más viejo esperó `ventana_maxima_segundos`). Si hay varias
+    tareas pendientes del mismo remitente, `combinar` las une en una sola.
+    """
+
+    def __init__(self,
+                 procesador,
+                 workers=8,
+                 max_pendientes=2000,
+                 ventana_segundos=0,
+                 ventana_maxima_segundos=10,
+                 combinar=None):
+        self.procesador = procesador
+        self.workers = workers
+        self.max_pendientes = max_pendientes
+        self.ventana_segundos = ventana_segundos
+        self.ventana_maxima_segundos = ventana_maxima_segundos
+        self.combinar = combinar
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pendientes = {}  # remitente -> deque de (llegada, tarea)
+        self._programados = set()  # remitentes esperando que cierre la ventana
+        self._listos = queue.Queue()  # remitentes listos para procesar
+        self._total_pendientes = 0
+        self._ocupados = 0
+        self._iniciada = False
+        self._inicio = None
+
+        self._procesados = 0
+        self._agrupados = 0
+        self._errores = 0
+        self._rechazados = 0
+        self._tiempo_ocupado = 0.0
+
+    def iniciar(self):
+        """Arranca los workers (una sola vez)"""
+        with self._lock:
+            if self._iniciada:
+                return
+            self._iniciada = True
+            self._inicio = time.time()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name=f'worker-mensajes-{i}',
+                                      daemon=True)
+            thread.start()
+
+        if self.ventana_segundos > 0:
+            thread = threading.Thread(target=self._planificador,
+                                      name='planificador-mensajes',
+                                      daemon=True)
+            thread.start()
+
+        print(f'✅ Cola de mensajes iniciada ({self.workers} workers, '
+              f'ventana {self.ventana_segundos}s)')
+
+    def encolar(self, remitente, tarea):
+        """
+        Agrega una tarea a la cola del remitente.
+        Retorna False si la cola está llena.
+        """
+        return self.encolar_lote([(remitente, tarea)])
+
+    def encolar_lote(self, items):
+        """
+        Agrega varias tareas [(remitente, tarea), ...] de una sola vez.
+        Es todo o nada: si el lote no entra, no se encola ninguna
+        y retorna False.
+        """
+        if not self._iniciada:
+            self.iniciar()
+
+        ahora = time.time()
+        nuevos = []
+        with self._lock:
+            if self._total_pendientes + len(items) > self.max_pendientes:
+                self._rechazados += len(items)
+                return False
+
+            for remitente, tarea in items:
+                if remitente not in self._pendientes:
+                    self._pendientes[remitente] = deque()
+                    nuevos.append(remitente)
+                self._pendientes[remitente].append((ahora, tarea))
+                self._total_pendientes += 1
+
+            # Los remitentes que no estaban en cola ni en proceso quedan
+            # listos (o esperando la ventana de agrupado)
+            for remitente in nuevos:
+                self._despachar(remitente)
+
+        return True
+
+    def _despachar(self, remitente):
+        """Manda el remitente a los workers o a esperar la ventana (con lock)"""
+        if self.ventana_segundos > 0:
+            self._programados.add(remitente)
+            self._cond.notify()
+        else:
+            self._listos.put(remitente)
+
+    def _listo_en(self, remitente):
+        """Momento en que cierra la ventana de agrupado del remitente"""
+        cola = self._pendientes[remitente]
+        return min(cola[-1][0] + self.ventana_segundos,
+                   cola[0][0] + self.ventana_maxima_segundos)
+
+    def _planificador(self):
+        with self._cond:
+            while True:
+                ahora = time.time()
+                proximo = None
+                for remitente in list(self._programados):
+                    listo_en = self._listo_en(remitente)
+                    if listo_en <= ahora:
+                        self._programados.discard(remitente)
+                        self._listos.put(remitente)
+                    elif proximo is None or listo_en < proximo:
+                        proximo = listo_en
+
+                self._cond.wait(proximo - ahora if proximo else None)
+
+    def _worker(self):
+        while True:
+            remitente = self._listos.get()
+
+            with self._lock:
+                cola = self._pendientes[remitente]
+                if self.combinar and len(cola) > 1:
+                    tareas = [tarea for _, tarea in cola]
+                    cola.clear()
+                else:
+                    tareas = [cola.popleft()[1]]
+                self._total_pendientes -= len(tareas)
+                self._agrupados += len(tareas) - 1
+                self._ocupados += 1
+
+            inicio = time.time()
+            try:
+                if len(tareas) > 1:
+                    self.procesador(self.combinar(tareas))
+                else:
+                    self.procesador(tareas[0])
+                error = False
+            except Exception as e:
+                print(f'❌ Error en worker de mensajes: {e}')
+                error = True
+
+            with self._lock:
+                self._ocupados -= 1
+                self._tiempo_ocupado += time.time() - inicio
+                self._procesados += 1
+                if error:
+                    self._errores += 1
+
+                # Si el remitente mandó más mensajes mientras tanto, vuelve a la fila
+                if self._pendientes[remitente]:
+                    self._despachar(remitente)
+                else:
+                    del self._pendientes[remitente]
+
+    def metricas(self):
+        """Profundidad de la cola y utilización de los workers"""
+        with self._lock:
+            uptime = time.time() - self._inicio if self._inicio else 0
+            capacidad = self.workers * uptime
+            return {
+                'pendientes': self._total_pendientes,
+                'remitentes_pendientes': len(self._pendientes),
+                'remitentes_en_ventana': len(self._programados),
+                'max_pendientes': self.max_pendientes,
+                'ventana_segundos': self.ventana_segundos,
+                'workers': self.workers,
+                'workers_ocupados': self._ocupados,
+                'utilizacion_actual': self._ocupados / self.workers,
+                'utilizacion_promedio':
+                self._tiempo_ocupado / capacidad if capacidad else 0,
+                'procesados': self._procesados,
+                'agrupados': self._agrupados,
+                'errores': self._errores,
+                'rechazados': self._rechazados
+            }
+
+
+class DeduplicadorMensajes:
+    """
+    Recuerda los ids de mensajes de WhatsApp ya recibidos durante `ttl_segundos`.
+    Primero mira un caché en memoria; si no está, lo inserta en una colección
+    de MongoDB con _id = id del mensaje e índice TTL (compartida entre
+    procesos y reinicios). Un duplicado cuesta un solo insert indexado.
+    """
+
+    def __init__(self, obtener_coleccion, ttl_segundos=7 * 24 * 60 * 60,
+                 max_memoria=50000):
+        self.obtener_coleccion = obtener_coleccion
+        self.ttl_segundos = ttl_segundos
+        self.max_memoria = max_memoria
+
+        self._lock = threading.Lock()
+        self._vistos = OrderedDict()  # id -> timestamp (orden de llegada)
+        self._indice_creado = False
+
+    def _purgar_memoria(self, ahora):
+        while self._vistos:
+            mensaje_id, visto = next(iter(self._vistos.items()))
+            if ahora - visto < self.ttl_segundos and len(
+                    self._vistos) <= self.max_memoria:
+                break
+            self._vistos.popitem(last=False)
+
+    def _coleccion(self):
+        coleccion = self.obtener_coleccion()
+        if coleccion is not None and not self._indice_creado:
+            # Solo se marca si se creó: ante un error transitorio se
+            # reintenta en la próxima llamada (sin TTL la colección crece)
+            try:
+                coleccion.create_index('recibido',
+                                       expireAfterSeconds=self.ttl_segundos)
+                self._indice_creado = True
+            except Exception as e:
+                print(f'⚠️ Índice TTL de dedupe (se reintenta): {e}')
+        return coleccion
+
+    def registrar_lote(self, ids):
+        """
+        Registra los ids recibidos y retorna el set de los que son NUEVOS.
+        Si MongoDB falla, se consideran nuevos (mejor responder dos veces
+        que no responder).
+        """
+        ahora = time.time()
+        candidatos = []
+
+        with self._lock:
+            self._purgar_memoria(ahora)
+            for mensaje_id in ids:
+                if mensaje_id in self._vistos:
+                    continue
+                self._vistos[mensaje_id] = ahora
+                candidatos.append(mensaje_id)
+
+        if not candidatos:
+            return set()
+
+        nuevos = set(candidatos)
+        try:
+            coleccion = self._coleccion()
+            if coleccion is None:
+                return nuevos
+
+            recibido = datetime.utcnow()
+            coleccion.insert_many([{
+                '_id': mensaje_id,
+                'recibido': recibido
+            } for mensaje_id in candidatos],
+                                  ordered=False)
+
+        except BulkWriteError as e:
+            # Código 11000: el id ya estaba en Mongo (otro proceso o reinicio)
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == 11000:
+                    nuevos.discard(candidatos[error['index']])
+
+        except Exception as e:
+            print(f'⚠️ Dedupe sin MongoDB: {e}')
+
+        return nuevos
+
+    def olvidar(self, ids):
+        """
+        Borra ids registrados (ej: si no se pudieron encolar y Meta
+        los va a reintentar).
+        """
+        with self._lock:
+            for mensaje_id in ids:
+                self._vistos.pop(mensaje_id, None)
+
+        try:
+            coleccion = self._coleccion()
+            if coleccion is not None:
+                coleccion.delete_many({'_id': {'$in': list(ids)}})
+        except Exception as e:
+            print(f'⚠️ Error olvidando ids de dedupe: {e}')
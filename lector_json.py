@@ -0,0 +1,104 @@
+"""
+Lectura incremental de JSON grandes.
+Recorre los elementos de un array dentro del objeto raíz a medida que
+llegan los fragmentos de la descarga, sin tener el cuerpo entero (ni la
+lista parseada) en memoria.
+"""
+
+import codecs
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_ESPACIOS = re.compile(r'\s*')
+
+# Se descarta lo ya leído del buffer cuando supera este tamaño
+_MAX_CONSUMIDO = 1 << 16
+
+
+class _Lector:
+    """Buffer de texto que se llena con fragmentos (bytes) a pedido"""
+
+    def __init__(self, fragmentos):
+        self._fragmentos = iter(fragmentos)
+        self._decodificador = codecs.getincrementaldecoder('utf-8')()
+        self.texto = ''
+        self.pos = 0
+        self.fin = False
+
+    def leer_mas(self):
+        """Agrega el próximo fragmento; False si ya no hay más"""
+        if self.fin:
+            return False
+        if self.pos > _MAX_CONSUMIDO:
+            self.texto = self.texto[self.pos:]
+            self.pos = 0
+        for fragmento in self._fragmentos:
+            if fragmento:
+                self.texto += self._decodificador.decode(fragmento)
+                return True
+        self.texto += self._decodificador.decode(b'', final=True)
+        self.fin = True
+        return False
+
+    def caracter(self):
+        """Próximo caracter que no sea espacio (sin consumirlo), o '' al final"""
+        while True:
+            self.pos = _ESPACIOS.match(self.texto, self.pos).end()
+            if self.pos < len(self.texto):
+                return self.texto[self.pos]
+            if not self.leer_mas():
+                return ''
+
+    def esperar(self, caracteres):
+        """Consume el próximo caracter, que tiene que ser uno de `caracteres`"""
+        caracter = self.caracter()
+        if not caracter or caracter not in caracteres:
+            raise ValueError(f'JSON inválido en {self.pos}: se esperaba '
+                             f'{caracteres!r} y vino {caracter!r}')
+        self.pos += 1
+        return caracter
+
+    def valor(self):
+        """Decodifica el próximo valor completo (pide fragmentos si falta)"""
+        self.caracter()
+        while True:
+            try:
+                valor, fin = _decoder.raw_decode(self.texto, self.pos)
+                # Un número al final del buffer puede seguir en el próximo fragmento
+                if fin < len(self.texto) or self.fin:
+                    self.pos = fin
+                    return valor
+            except json.JSONDecodeError:
+                if self.fin:
+                    raise
+            self.leer_mas()
+
+
+def iterar_array_json(fragmentos, clave):
+    """
+    Genera los elementos de `raiz[clave]` (un array) a partir de los
+    fragmentos en bytes de un JSON cuya raíz es un objeto. Las demás
+    claves se saltean; si `clave` no está, no genera nada.
+    """
+    lector = _Lector(fragmentos)
+    lector.esperar('{')
+    if lector.caracter() == '}':
+        return
+
+    while True:
+        nombre = lector.valor()
+        lector.esperar(':')
+
+        if nombre == clave and lector.caracter() == '[':
+            lector.esperar('[')
+            if lector.caracter() == ']':
+                return
+            while True:
+                yield lector.valor()
+                if lector.esperar(',]') == ']':
+                    return
+
+        lector.valor()
+        if lector.esperar(',}') == '}':
+            return
@@ -1,19 +1,33 @@
 import os
 from flask import Flask, request, jsonify, send_from_directory
-from pymongo import MongoClient, ASCENDING
+import pymongo
+from pymongo import MongoClient, ASCENDING, ReplaceOne
 from datetime import datetime, timedelta
 import requests
 import json
 from openai import OpenAI
 
 try:
-    from normalizador_productos import normalizar_busqueda, obtener_variantes_busqueda
+    from normalizador_productos import (normalizar_busqueda,
+                                        obtener_variantes_busqueda,
+                                        extraer_terminos_locales,
+                                        actualizar_vocabulario_catalogo)
     NORMALIZADOR_DISPONIBLE = True
     print('✅ Normalizador de productos cargado')
 except ImportError:
     NORMALIZADOR_DISPONIBLE = False
     print('⚠️ Normalizador no disponible')
 
+import metricas
+from cola_mensajes import ColaPorRemitente, DeduplicadorMensajes
+from cache_memoria import CacheLRU, CacheCompartido, NO_ENCONTRADO
+from catalogo_productos import (IndiceCatalogo, Catalogo, ProductoCatalogo,
+                                extraer_facetas, similitud_alternativa,
+                                CAMPOS_FACETA, PROYECCION_CATALOGO)
+from lector_json import iterar_array_json
+from plazos import (Plazo, PlazoAgotado, con_plazo, timeout_para,
+                    es_error_de_plazo, enviar_con_plazo)
+
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -21,8 +35,11 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Tabl
 from reportlab.lib.units import mm
 import uuid
 import glob
+import hashlib
+import itertools
 import threading
 import time as time_module
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeout
 import random
 import smtplib
 from email.mime.text import MIMEText
@@ -46,7 +63,24 @@ app = Flask(__name__)
 
 cliente_mongo = None
 db = None
-cliente_openai = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+# Un solo reintento: cada intento ya usa el timeout que deja el plazo del mensaje
+cliente_openai = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'),
+                        max_retries=int(
+                            os.environ.get('OPENAI_MAX_REINTENTOS', 1)))
+# Los crons no tienen plazo: pueden reintentar más
+cliente_openai_cron = cliente_openai.with_options(max_retries=int(
+    os.environ.get('OPENAI_MAX_REINTENTOS_CRON', 3)))
+
+# Executor compartido y acotado para llamadas a OpenAI en paralelo
+# y para tareas que no afectan la respuesta (memoria del cliente)
+executor_llm = ThreadPoolExecutor(max_workers=int(
+    os.environ.get('WORKERS_LLM', 16)),
+                                  thread_name_prefix='llm')
+
+# Executor para búsquedas en la API externa de productos (una por término)
+executor_busquedas = ThreadPoolExecutor(max_workers=int(
+    os.environ.get('WORKERS_BUSQUEDA', 8)),
+                                        thread_name_prefix='busqueda')
 
 # Crear carpeta para presupuestos en /tmp (persiste mejor en Replit)
 PRESUPUESTOS_DIR = '/tmp/presupuestos'
@@ -58,6 +92,9 @@ else:
 
 DIAS_EXPIRACION = 15
 
+# Confianza mínima del extractor local para no llamar a OpenAI
+UMBRAL_CONFIANZA_LOCAL = float(os.environ.get('UMBRAL_CONFIANZA_LOCAL', 0.8))
+
 # URL del backend ISR para sincronización de presupuestos
 ISR_API_URL = os.environ.get('ISR_API_URL',
                              'https://isr-web--pansapablo.replit.app')
@@ -120,8 +157,7 @@ def sincronizar_clientes_cianbox():
             print('❌ MongoDB no conectado, no se puede sincronizar')
             return False
 
-        from services.cianbox_service import get_token, CIANBOX_BASE_URL
-        import requests
+        from services.cianbox_service import get_token, descargar_paginas
 
         token = get_token()
         if not token:
@@ -130,43 +166,17 @@ def sincronizar_clientes_cianbox():
 
         print('🔄 Iniciando sincronización de clientes Cianbox...')
 
-        todos_clientes = []
-        pagina = 1
-        limit = 100
-
-        while True:
-            response = requests.get(f'{CIANBOX_BASE_URL}/clientes',
-                                    params={
-                                        'access_token': token,
-                                        'limit': limit,
-                                        'page': pagina
-                                    },
-                                    timeout=30)
-
-            if response.status_code != 200:
-                print(f'❌ Error en página {pagina}: {response.status_code}')
-                break
-
-            data = response.json()
-            if data.get('status') != 'ok':
-                print(f'❌ Error en página {pagina}: {data.get("message")}')
-                break
+        # Páginas en paralelo hasta la primera vacía (sin tope de páginas)
+        inicio = time_module.perf_counter()
+        todos_clientes, paginas = descargar_paginas('clientes', por_pagina=100)
+        segundos = time_module.perf_counter() - inicio
 
-            clientes = data.get('body', [])
-            if not clientes:
-                break
-
-            todos_clientes.extend(clientes)
-            print(
-                f'📥 Página {pagina}: {len(clientes)} clientes (total: {len(todos_clientes)})'
-            )
-
-            pagina += 1
-
-            # Seguridad: máximo 200 páginas
-            if pagina > 200:
-                print('⚠️ Límite de páginas alcanzado')
-                break
+        paginas_por_segundo = paginas / segundos if segundos else 0
+        metricas.observar('sync_clientes.descarga_segundos', segundos)
+        metricas.observar('sync_clientes.paginas_por_segundo',
+                          paginas_por_segundo)
+        print(f'📥 Clientes Cianbox: {len(todos_clientes)} en {paginas} '
+              f'páginas, {segundos:.1f}s ({paginas_por_segundo:.1f} páginas/s)')
 
         if not todos_clientes:
             print('⚠️ No se encontraron clientes en Cianbox')
@@ -239,17 +249,215 @@ def sincronizar_clientes_cianbox():
 # ============== SINCRONIZACIÓN PRODUCTOS ==============
 
 
-def sincronizar_productos_cache():
+# Documentos por insert_many / bulk_write al sincronizar el catálogo
+TAMANO_LOTE_SYNC = int(os.environ.get('TAMANO_LOTE_SYNC', 1000))
+
+# Bytes por fragmento al descargar el catálogo en streaming
+TAMANO_FRAGMENTO_DESCARGA = int(
+    os.environ.get('TAMANO_FRAGMENTO_DESCARGA', 64 * 1024))
+
+# La sincronización completa arma esta colección y la renombra a productos_cache
+COLECCION_PRODUCTOS_STAGING = 'productos_cache_staging'
+
+# Una sola sincronización a la vez (cron y endpoint manual)
+lock_sync_productos = threading.Lock()
+
+# Campos que definen si un producto cambió (el hash se guarda en cada
+# documento y la sincronización incremental solo escribe los distintos).
+# Incluye las facetas: si cambia extraer_facetas se reescriben todas.
+CAMPOS_HASH_PRODUCTO = ('nombre', 'codigo', 'marca', 'precio_usd',
+                        'precio_ars', 'stock', 'categoria', 'categoria_id',
+                        'marca_id', 'imagen', 'descripcion', 'facetas')
+
+# Claves de productos que se guardan en cada entrada de productos_cambios
+MAX_CLAVES_CHANGELOG = 100
+
+
+def hash_producto(documento):
+    """Hash del contenido relevante de un documento de productos_cache"""
+    contenido = json.dumps([documento.get(campo) for campo in CAMPOS_HASH_PRODUCTO],
+                           default=str, sort_keys=True)
+    return hashlib.sha1(contenido.encode('utf-8')).hexdigest()
+
+
+def documento_desde_producto_api(p, sincronizado):
+    """Producto de ConsProductos → documento de productos_cache"""
+    nombre = (p.get('producto', '') or '').replace('**', '')
+    codigo = p.get('codigoInterno', '') or ''
+    marca = p.get('marca', '') or ''
+
+    documento = {
+        # Identidad del producto entre sincronizaciones
+        'clave': codigo or nombre,
+        'nombre': nombre,
+        'nombre_lower': nombre.lower(),
+        'codigo': codigo,
+        'codigo_lower': codigo.lower(),
+        'marca': marca,
+        'marca_lower': marca.lower(),
+        'precio_usd': p.get('precioUSD', 0),
+        'precio_ars': p.get('precioARS', 0),
+        'stock': p.get('stockTotal', 0),
+        'categoria': p.get('categoria', ''),
+        'categoria_id': p.get('categoriaId', 0),
+        'marca_id': p.get('marcaId', 0),
+        'imagen': p.get('imagenes', [None])[0] if p.get('imagenes') else None,
+        'descripcion': p.get('descripcion', ''),
+        'facetas': extraer_facetas(nombre, marca),
+        'iva': 21,
+        'sincronizado': sincronizado
+    }
+    documento['hash'] = hash_producto(documento)
+    return documento
+
+
+def documento_para_indice(documento):
+    """Solo los campos que usa el índice en memoria (sin descripción ni imagen)"""
+    return {
+        campo: documento.get(campo)
+        for campo in PROYECCION_CATALOGO if campo != '_id'
+    }
+
+
+def medir_tiempo(iterable, tiempos, fase):
+    """Recorre `iterable` sumando en tiempos[fase] lo que tarda cada elemento"""
+    iterador = iter(iterable)
+    while True:
+        inicio = time_module.perf_counter()
+        try:
+            elemento = next(iterador)
+        except StopIteration:
+            return
+        finally:
+            tiempos[fase] = tiempos.get(fase, 0) + time_module.perf_counter() - inicio
+        yield elemento
+
+
+def preparar_staging_productos():
+    """Colección staging vacía para una sincronización completa"""
+    # Restos de una sincronización que falló a mitad de camino
+    db.drop_collection(COLECCION_PRODUCTOS_STAGING)
+    return db[COLECCION_PRODUCTOS_STAGING]
+
+
+def publicar_staging_productos(staging):
+    """
+    Crea los índices en la colección staging y la renombra a
+    productos_cache (renameCollection, atómico): nadie ve el catálogo
+    vacío o a medias, y si algo falla antes queda el anterior.
+    """
+    staging.create_index('clave')
+    staging.create_index('nombre_lower')
+    staging.create_index('codigo_lower')
+    staging.create_index('marca_lower')
+    for campo in CAMPOS_FACETA:
+        staging.create_index([(f'facetas.{campo}', ASCENDING),
+                              ('stock', -1)])
+
+    # Swap atómico: los índices viajan con la colección
+    staging.rename('productos_cache', dropTarget=True)
+
+
+def escribir_lote_productos(coleccion, lote, completa):
+    """
+    Escribe un lote: insert_many en la staging (completa) o upsert por
+    clave con bulk_write sobre productos_cache (incremental).
+    """
+    if completa:
+        coleccion.insert_many(lote, ordered=False)
+    else:
+        coleccion.bulk_write([
+            ReplaceOne({'clave': documento['clave']}, documento, upsert=True)
+            for documento in lote
+        ],
+                             ordered=False)
+
+
+def eliminar_productos(coleccion, claves):
+    """Borra de productos_cache los productos que la API ya no trae"""
+    for inicio in range(0, len(claves), TAMANO_LOTE_SYNC):
+        coleccion.delete_many(
+            {'clave': {
+                '$in': claves[inicio:inicio + TAMANO_LOTE_SYNC]
+            }})
+
+
+def leer_hashes_productos():
+    """
+    {clave: hash} de productos_cache, o None si no sirve para comparar
+    (vacío, o sincronizado antes de que existieran los hashes).
+    """
+    hashes = {}
+    for doc in db['productos_cache'].find({}, {'_id': 0, 'clave': 1, 'hash': 1}):
+        if not doc.get('clave') or not doc.get('hash'):
+            return None
+        hashes[doc['clave']] = doc['hash']
+    return hashes or None
+
+
+def registrar_cambios_productos(modo, agregadas, actualizadas, eliminadas,
+                                sin_cambios):
+    """Guarda una entrada en productos_cambios (claves) y suma las métricas"""
+    cambios = {
+        'fecha': datetime.utcnow(),
+        'modo': modo,
+        'agregados': len(agregadas),
+        'actualizados': len(actualizadas),
+        'eliminados': len(eliminadas),
+        'sin_cambios': sin_cambios,
+        'claves_agregadas': agregadas[:MAX_CLAVES_CHANGELOG],
+        'claves_actualizadas': actualizadas[:MAX_CLAVES_CHANGELOG],
+        'claves_eliminadas': eliminadas[:MAX_CLAVES_CHANGELOG]
+    }
+
+    for campo in ('agregados', 'actualizados', 'eliminados'):
+        metricas.incrementar(f'sync_productos.{campo}', cambios[campo])
+    print(f"📝 Cambios de productos ({modo}): {cambios['agregados']} nuevos, "
+          f"{cambios['actualizados']} actualizados, "
+          f"{cambios['eliminados']} eliminados, {sin_cambios} sin cambios")
+
+    try:
+        db['productos_cambios'].insert_one(cambios)
+    except Exception as e:
+        print(f'⚠️ Error guardando cambios de productos: {e}')
+
+
+def sincronizar_productos_cache(incremental=False):
     """
     Descarga TODOS los productos de seguridadrosario.com 
     y los guarda en MongoDB para búsqueda local con "contiene".
+
+    La respuesta se lee en streaming: cada producto se transforma apenas
+    se parsea y se escribe en lotes (TAMANO_LOTE_SYNC), así que en memoria
+    solo quedan un lote y los campos que necesita el índice.
+    Reporta el tiempo de cada fase.
+
+    Completa: carga una colección staging y la renombra a productos_cache.
+    Incremental: solo escribe los nuevos, cambiados y eliminados. Si no hay
+    hashes guardados hace la completa.
+    En los dos modos los cambios registrados salen de comparar el hash de
+    cada producto con el guardado.
     """
-    try:
-        if db is None:
-            print('❌ MongoDB no conectado, no se puede sincronizar productos')
-            return False
+    if db is None:
+        print('❌ MongoDB no conectado, no se puede sincronizar productos')
+        return False
+
+    if not lock_sync_productos.acquire(blocking=False):
+        print('⚠️ Ya hay una sincronización de productos en curso')
+        return False
 
-        print('🔄 Iniciando sincronización de productos...')
+    try:
+        modo = 'incremental' if incremental else 'completa'
+        print(f'🔄 Iniciando sincronización de productos ({modo})...')
+        tiempos = {}
+
+        inicio = time_module.perf_counter()
+        hashes = leer_hashes_productos() or {}
+        tiempos['comparacion'] = time_module.perf_counter() - inicio
+        if incremental and not hashes:
+            print('ℹ️ Sin hashes guardados, sincronización completa')
+            modo = 'completa'
+        completa = modo == 'completa'
 
         url = 'https://seguridadrosario.com/IDSRBE/Productos/ConsProductos'
         params = {
@@ -261,165 +469,425 @@ def sincronizar_productos_cache():
             'Oferta': 'false'
         }
 
-        response = requests.get(url, params=params, timeout=60)
+        inicio = time_module.perf_counter()
+        response = requests.get(url, params=params, timeout=60, stream=True)
+        segundos_conexion = time_module.perf_counter() - inicio
 
         if response.status_code != 200:
             print(f'❌ Error obteniendo productos: {response.status_code}')
+            response.close()
             return False
 
-        data = response.json()
-        productos_raw = data.get('producto', [])
-
-        if not productos_raw:
+        fragmentos = medir_tiempo(
+            response.iter_content(chunk_size=TAMANO_FRAGMENTO_DESCARGA),
+            tiempos, 'descarga')
+        productos_api = medir_tiempo(iterar_array_json(fragmentos, 'producto'),
+                                     tiempos, 'parseo')
+
+        coleccion = preparar_staging_productos(
+        ) if completa else db['productos_cache']
+        sincronizado = datetime.utcnow()
+        documentos = []  # solo campos del índice
+        lote = []
+        agregadas = []
+        actualizadas = []
+        vistas = set()
+        recibidos = 0
+
+        with response:
+            for p in productos_api:
+                recibidos += 1
+
+                inicio = time_module.perf_counter()
+                documento = documento_desde_producto_api(p, sincronizado)
+                clave = documento['clave']
+                # Si la API repite un código queda el primero
+                if clave and clave not in vistas:
+                    vistas.add(clave)
+                    documentos.append(documento_para_indice(documento))
+
+                    # La completa escribe todo en staging; la incremental
+                    # solo lo distinto
+                    anterior = hashes.get(clave)
+                    if anterior is None:
+                        agregadas.append(clave)
+                    elif anterior != documento['hash']:
+                        actualizadas.append(clave)
+                    if completa or anterior != documento['hash']:
+                        lote.append(documento)
+                tiempos['transformacion'] = tiempos.get(
+                    'transformacion', 0) + time_module.perf_counter() - inicio
+
+                if len(lote) >= TAMANO_LOTE_SYNC:
+                    inicio = time_module.perf_counter()
+                    escribir_lote_productos(coleccion, lote, completa)
+                    lote = []
+                    tiempos['escritura'] = tiempos.get(
+                        'escritura', 0) + time_module.perf_counter() - inicio
+
+        # El parser espera los fragmentos: esa espera es descarga, no parseo
+        tiempos['parseo'] = tiempos.get('parseo', 0) - tiempos.get('descarga', 0)
+        tiempos['descarga'] = tiempos.get('descarga', 0) + segundos_conexion
+
+        if not documentos:
             print('⚠️ No se encontraron productos')
+            if completa:
+                db.drop_collection(COLECCION_PRODUCTOS_STAGING)
             return False
 
-        print(f'📥 Recibidos {len(productos_raw)} productos')
-
-        coleccion = db['productos_cache']
-
-        coleccion.delete_many({})
-
-        for p in productos_raw:
-            nombre = (p.get('producto', '') or '').replace('**', '')
-            codigo = p.get('codigoInterno', '') or ''
-            marca = p.get('marca', '') or ''
-
-            coleccion.insert_one({
-                'nombre':
-                nombre,
-                'nombre_lower':
-                nombre.lower(),
-                'codigo':
-                codigo,
-                'codigo_lower':
-                codigo.lower(),
-                'marca':
-                marca,
-                'marca_lower':
-                marca.lower(),
-                'precio_usd':
-                p.get('precioUSD', 0),
-                'precio_ars':
-                p.get('precioARS', 0),
-                'stock':
-                p.get('stockTotal', 0),
-                'categoria':
-                p.get('categoria', ''),
-                'categoria_id':
-                p.get('categoriaId', 0),
-                'marca_id':
-                p.get('marcaId', 0),
-                'imagen':
-                p.get('imagenes', [None])[0] if p.get('imagenes') else None,
-                'descripcion':
-                p.get('descripcion', ''),
-                'iva':
-                21,
-                'sincronizado':
-                datetime.utcnow()
-            })
-
-        coleccion.create_index('nombre_lower')
-        coleccion.create_index('codigo_lower')
-        coleccion.create_index('marca_lower')
-
-        print(f'✅ Productos sincronizados: {len(productos_raw)} guardados')
+        print(f'📥 Recibidos {recibidos} productos')
+        if recibidos > len(documentos):
+            print(f'ℹ️ {recibidos - len(documentos)} productos repetidos '
+                  f'o sin código descartados')
+
+        inicio = time_module.perf_counter()
+        if lote:
+            escribir_lote_productos(coleccion, lote, completa)
+        eliminadas = [clave for clave in hashes if clave not in vistas]
+        if completa:
+            publicar_staging_productos(coleccion)
+        else:
+            eliminar_productos(coleccion, eliminadas)
+        tiempos['escritura'] = tiempos.get(
+            'escritura', 0) + time_module.perf_counter() - inicio
+
+        escritos = len(agregadas) + len(actualizadas) + len(eliminadas)
+        registrar_cambios_productos(
+            modo, agregadas, actualizadas, eliminadas,
+            len(documentos) - len(agregadas) - len(actualizadas))
+
+        # Sin cambios, el índice en memoria (y el caché de búsquedas) sigue valiendo
+        if escritos or catalogo.indice is None:
+            catalogo.publicar(IndiceCatalogo(documentos))
+
+            if NORMALIZADOR_DISPONIBLE:
+                actualizar_vocabulario_catalogo(
+                    f"{d['nombre_lower']} {d['codigo_lower']} {d['marca_lower']}"
+                    for d in documentos)
+        else:
+            catalogo.marcar_sincronizado()
+
+        total = sum(tiempos.values())
+        por_segundo = len(documentos) / total if total else 0
+        for fase, segundos in tiempos.items():
+            metricas.observar(f'sync_productos.{fase}_segundos', segundos)
+        metricas.observar('sync_productos.documentos_por_segundo', por_segundo)
+
+        detalle = ', '.join(f'{fase} {segundos:.1f}s'
+                            for fase, segundos in tiempos.items())
+        print(f'✅ Productos sincronizados ({modo}): {len(documentos)} '
+              f'procesados, {escritos} escritos en {total:.1f}s '
+              f'({por_segundo:.0f} docs/s; {detalle})')
         return True
 
     except Exception as e:
         print(f'❌ Error sincronizando productos: {e}')
         import traceback
         traceback.print_exc()
+        try:
+            db.drop_collection(COLECCION_PRODUCTOS_STAGING)
+        except Exception as e:
+            print(f'⚠️ No se pudo borrar {COLECCION_PRODUCTOS_STAGING}: {e}')
         return False
 
+    finally:
+        lock_sync_productos.release()
+
 
 def buscar_productos_cache(termino, solo_con_stock=True):
     """
-    Busca productos en el caché local de MongoDB.
+    Busca productos en el índice del catálogo en memoria (o, si todavía
+    no se armó, en el caché local de MongoDB). Si no hay resultados,
+    busca en la API externa.
     Por defecto solo retorna productos CON stock.
     """
+    return buscar_productos_lote([termino], solo_con_stock)[termino]
+
+
+def buscar_productos_lote(terminos, solo_con_stock=True):
+    """
+    Busca varios términos juntos (ej: todos los productos de un mensaje).
+    Retorna {termino: productos}. Los términos que no están en el
+    catálogo se buscan en la API externa, en paralelo.
+    """
+    terminos = list(dict.fromkeys(terminos))
+    resultados = {}
+
     try:
-        if db is None:
+        # Estado del catálogo en memoria: sin round trip para saber si hay datos
+        indice = catalogo.indice
+        # Arrancando (todavía sin estado ni índice): se busca en MongoDB;
+        # si productos_cache está vacío no encuentra nada y va a la API
+        cargando = catalogo.estado is None and db is not None
+        if not catalogo.listo() and not cargando:
+            print('⚠️ Caché vacío, usando API externa')
+        elif indice is None and db is None:
             print('⚠️ MongoDB no conectado, usando API externa')
-            return buscar_en_api_productos(termino)
+        else:
+            # Las búsquedas se repiten entre clientes: se recuerdan hasta que
+            # la sincronización publique una generación nueva del catálogo
+            generacion = indice.generacion if indice is not None else catalogo.generacion
+            claves = {
+                termino: (' '.join(termino.lower().split()), solo_con_stock,
+                          generacion)
+                for termino in terminos
+            }
 
-        coleccion = db['productos_cache']
+            pendientes = []
+            for termino in terminos:
+                productos = cache_busquedas.obtener(claves[termino])
+                if productos is NO_ENCONTRADO:
+                    pendientes.append(termino)
+                else:
+                    print(f'💾 Búsqueda "{termino}" desde caché → {len(productos)}')
+                    resultados[termino] = productos
 
-        if coleccion.count_documents({}) == 0:
-            print('⚠️ Caché vacío, usando API externa')
-            return buscar_en_api_productos(termino)
+            if pendientes:
+                encontrados = buscar_en_catalogo_lote(pendientes, solo_con_stock,
+                                                      indice)
+                for termino in pendientes:
+                    cache_busquedas.guardar(claves[termino], encontrados[termino])
+                    resultados[termino] = encontrados[termino]
+
+    except Exception as e:
+        print(f'❌ Error buscando en caché: {e}')
+
+    # Copias: quien llama puede modificar los productos
+    resultados = {
+        termino: [
+            p.copiar() if isinstance(p, ProductoCatalogo) else dict(p)
+            for p in resultados.get(termino) or []
+        ]
+        for termino in terminos
+    }
+
+    faltantes = [termino for termino in terminos if not resultados[termino]]
+    if not faltantes:
+        return resultados
+
+    print(f'🔎 Sin resultados en caché para {faltantes}, buscando en API...')
+    if len(faltantes) == 1:
+        resultados[faltantes[0]] = buscar_en_api_productos(faltantes[0])
+        return resultados
 
-        # Obtener variantes de búsqueda
+    futuros = {
+        termino: enviar_con_plazo(executor_busquedas, buscar_en_api_productos,
+                                  termino)
+        for termino in faltantes
+    }
+    for termino, futuro in futuros.items():
+        try:
+            resultados[termino] = futuro.result(timeout=timeout_para(30))
+        except FuturoTimeout:
+            print(f'⏱️ Búsqueda de "{termino}" en API sin respuesta a tiempo')
+            metricas.incrementar('busqueda_api.timeout')
+            resultados[termino] = []
+        except Exception as e:
+            print(f'❌ Error buscando "{termino}" en API: {e}')
+            resultados[termino] = []
+
+    return resultados
+
+
+def buscar_en_catalogo_lote(terminos, solo_con_stock, indice):
+    """
+    Busca cada término y sus variantes en el índice (o en MongoDB si
+    `indice` es None, con una sola agregación para todos).
+    Retorna {termino: hasta 10 productos, o [] si no hay}.
+    """
+    # Obtener variantes de búsqueda
+    variantes = {}
+    for termino in terminos:
         if NORMALIZADOR_DISPONIBLE:
-            variantes = obtener_variantes_busqueda(termino)
-            print(f'🔄 Variantes: {variantes[:3]}', flush=True)
+            variantes[termino] = obtener_variantes_busqueda(termino)
+            print(f'🔄 Variantes: {variantes[termino][:3]}', flush=True)
         else:
-            variantes = [termino.lower().strip()]
-
-        # Intentar cada variante
-        for variante in variantes:
-            palabras = variante.lower().strip().split()
-
-            condiciones = []
-            for palabra in palabras:
-                condiciones.append({
-                    '$or': [
-                        {'nombre_lower': {'$regex': palabra, '$options': 'i'}},
-                        {'codigo_lower': {'$regex': palabra, '$options': 'i'}},
-                        {'marca_lower': {'$regex': palabra, '$options': 'i'}}
-                    ]
-                })
+            variantes[termino] = [termino.lower().strip()]
+
+    # Resultados de cada variante, en orden de prioridad
+    if indice is not None:
+        # Si ninguna variante aparece tal cual, se reintenta corrigiendo
+        # errores de tipeo contra el vocabulario del catálogo
+        por_termino = {
+            termino: itertools.chain(
+                ((variante,
+                  indice.buscar(variante, limite=20, con_stock=solo_con_stock))
+                 for variante in lista),
+                ((variante,
+                  indice.buscar(variante,
+                                limite=20,
+                                tolerante=True,
+                                con_stock=solo_con_stock))
+                 for variante in lista))
+            for termino, lista in variantes.items()
+        }
+    else:
+        por_termino = buscar_variantes_mongo(db['productos_cache'],
+                                             variantes, solo_con_stock)
 
-            if condiciones:
-                query = {'$and': condiciones}
-            else:
-                query = {}
+    return {
+        termino: elegir_resultados_variante(por_termino[termino], solo_con_stock)
+        for termino in terminos
+    }
 
-            # Ordenar por stock (mayor primero)
-            resultados = list(coleccion.find(query).sort('stock', -1).limit(20))
 
-            if resultados:
-                productos = []
-                for p in resultados:
-                    stock = p.get('stock', 0)
-                    # Filtrar sin stock si está activado
-                    if solo_con_stock and stock <= 0:
-                        continue
-                    productos.append({
-                        'name': p.get('nombre', ''),
-                        'nombre': p.get('nombre', ''),
-                        'price': p.get('precio_usd', 0),
-                        'precio': p.get('precio_usd', 0),
-                        'stock': stock,
-                        'cantidad': stock,
-                        'sku': p.get('codigo', ''),
-                        'codigo': p.get('codigo', ''),
-                        'iva': p.get('iva', 21),
-                        'marca': p.get('marca', ''),
-                        'categoria': p.get('categoria', '')
-                    })
+def elegir_resultados_variante(por_variante, solo_con_stock):
+    """Resultados de la primera variante que tenga productos (con stock si se pide)"""
+    for variante, resultados in por_variante:
+        if resultados:
+            productos = []
+            for p in resultados:
+                # Filtrar sin stock si está activado
+                if solo_con_stock and p.get('stock', 0) <= 0:
+                    continue
+                producto = producto_desde_catalogo(p)
+                producto['variante'] = variante
+                productos.append(producto)
 
-                if productos:
-                    print(f'🔎 Caché: "{variante}" → {len(productos)} con stock')
-                    return productos[:10]
+            if productos:
+                print(f'🔎 Caché: "{variante}" → {len(productos)} con stock')
+                return productos[:10]
+
+    return []
+
+
+def consulta_variante_mongo(variante):
+    """Filtro "contiene" con $regex para una variante de búsqueda"""
+    import re
+    palabras = variante.lower().strip().split()
+
+    condiciones = []
+    for palabra in palabras:
+        # Texto del cliente: un "(" o "[" sin escapar rompe toda la agregación
+        palabra = re.escape(palabra)
+        condiciones.append({
+            '$or': [
+                {'nombre_lower': {'$regex': palabra, '$options': 'i'}},
+                {'codigo_lower': {'$regex': palabra, '$options': 'i'}},
+                {'marca_lower': {'$regex': palabra, '$options': 'i'}}
+            ]
+        })
+
+    if condiciones:
+        return {'$and': condiciones}
+    return {}
+
+
+def buscar_variantes_mongo(coleccion, variantes_por_termino,
+                           solo_con_stock=False):
+    """
+    Busca TODAS las variantes de todos los términos en MongoDB en una sola
+    agregación ($facet), sin índice en memoria: un solo viaje y una sola
+    pasada por la colección que alimenta todas las ramas.
+    Retorna {termino: [(variante, resultados), ...]} en el mismo orden de
+    prioridad; cada resultado viene marcado con la variante que lo
+    encontró. Ordena por stock (mayor primero), hasta 20.
+    """
+    facetas = {}
+    claves = {}
+    for t, (termino, variantes) in enumerate(variantes_por_termino.items()):
+        claves[termino] = []
+        for v, variante in enumerate(dict.fromkeys(variantes)):
+            clave = f't{t}v{v}'
+            claves[termino].append((variante, clave))
+            filtro = consulta_variante_mongo(variante)
+            if solo_con_stock:
+                filtro = {'$and': [filtro, {'stock': {'$gt': 0}}]}
+            facetas[clave] = [{
+                '$match': filtro
+            }, {
+                '$sort': {
+                    'stock': -1
+                }
+            }, {
+                '$limit': 20
+            }, {
+                '$project': PROYECCION_CATALOGO
+            }, {
+                # $literal: la variante es texto del cliente, no una expresión
+                '$addFields': {
+                    'variante': {
+                        '$literal': variante
+                    }
+                }
+            }]
+
+    resultado = next(coleccion.aggregate([{'$facet': facetas}]),
+                     {}) if facetas else {}
+    return {
+        termino: [(variante, resultado.get(clave, []))
+                  for variante, clave in lista]
+        for termino, lista in claves.items()
+    }
 
-        print(f'🔎 Sin resultados en caché, buscando en API...')
-        return buscar_en_api_productos(termino)
+
+def cargar_catalogo_en_memoria():
+    """
+    Arma el índice del catálogo (y el vocabulario del extractor local)
+    desde el caché de productos en MongoDB. Se usa al arrancar.
+    """
+    try:
+        if db is None:
+            return
+
+        catalogo.cargar_estado()
+
+        productos = list(db['productos_cache'].find(
+            {}, dict(PROYECCION_CATALOGO, sincronizado=1)))
+        if not productos:
+            return
+
+        # Sin estado guardado (primer arranque): la fecha sale de los documentos
+        sincronizado = max((p['sincronizado'] for p in productos
+                            if p.get('sincronizado')),
+                           default=None)
+        catalogo.publicar(IndiceCatalogo(productos),
+                          sincronizado=sincronizado,
+                          nueva_generacion=False)
+
+        if NORMALIZADOR_DISPONIBLE:
+            actualizar_vocabulario_catalogo(
+                f"{p.get('nombre_lower', '')} {p.get('codigo_lower', '')} {p.get('marca_lower', '')}"
+                for p in productos)
 
     except Exception as e:
-        print(f'❌ Error buscando en caché: {e}')
-        return buscar_en_api_productos(termino)
+        print(f'❌ Error cargando catálogo en memoria: {e}')
+
+
+catalogo = Catalogo(lambda: db['catalogo_estado']
+                    if db is not None else None)
+metricas.registrar_fuente('catalogo', catalogo.metricas)
+
+# Resultados de búsqueda por (término, solo_con_stock, generación)
+cache_busquedas = CacheLRU(
+    max_items=int(os.environ.get('CACHE_BUSQUEDAS_ITEMS', 2000)))
+catalogo.al_publicar(cache_busquedas.limpiar)
+metricas.registrar_fuente('cache_busquedas', cache_busquedas.metricas)
+
+
+# Sincronización incremental (stock y precios) y completa de productos
+INTERVALO_SYNC_INCREMENTAL_MINUTOS = float(
+    os.environ.get('INTERVALO_SYNC_INCREMENTAL_MINUTOS', 5))
+INTERVALO_SYNC_COMPLETA_HORAS = float(
+    os.environ.get('INTERVALO_SYNC_COMPLETA_HORAS', 6))
 
 
 def cron_sincronizacion_productos():
     """
-    Ejecuta sincronización de productos cada 6 horas.
+    Sincronización incremental de productos cada pocos minutos
+    y completa cada 6 horas.
     """
+    ultima_completa = time_module.time()
     while True:
-        time_module.sleep(6 * 60 * 60)
-        print('⏰ Cron: Sincronizando productos...')
-        sincronizar_productos_cache()
+        time_module.sleep(INTERVALO_SYNC_INCREMENTAL_MINUTOS * 60)
+        if time_module.time(
+        ) - ultima_completa >= INTERVALO_SYNC_COMPLETA_HORAS * 60 * 60:
+            print('⏰ Cron: Sincronizando productos (completa)...')
+            if sincronizar_productos_cache():
+                ultima_completa = time_module.time()
+        else:
+            print('⏰ Cron: Sincronizando productos (incremental)...')
+            sincronizar_productos_cache(incremental=True)
 
 
 def iniciar_cron_productos():
@@ -427,7 +895,9 @@ def iniciar_cron_productos():
     thread = threading.Thread(target=cron_sincronizacion_productos,
                               daemon=True)
     thread.start()
-    print('✅ Cron de sincronización productos iniciado (cada 6hs)')
+    print(f'✅ Cron de sincronización productos iniciado (incremental cada '
+          f'{INTERVALO_SYNC_INCREMENTAL_MINUTOS:g} min, completa cada '
+          f'{INTERVALO_SYNC_COMPLETA_HORAS:g}hs)')
 
 
 def buscar_cliente_en_cache(celular=None, email=None, cuit=None):
@@ -655,7 +1125,8 @@ def enviar_email(destinatario, asunto, cuerpo_html):
         parte_html = MIMEText(cuerpo_html, 'html')
         msg.attach(parte_html)
 
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
+        with smtplib.SMTP_SSL('smtp.gmail.com', 465,
+                              timeout=timeout_para(30)) as server:
             server.login(email_user, email_pass)
             server.sendmail(email_user, destinatario, msg.as_string())
 
@@ -775,74 +1246,6 @@ def notificar_compras_sin_stock(producto, cliente_nombre, cliente_telefono,
         return False
 
 
-def extraer_datos_personales(texto, datos_actuales=None):
-    """Extrae información personal/humana de la conversación para generar vínculo"""
-    try:
-        datos = datos_actuales or {}
-        memoria = datos.get('memoria_conversaciones', [])
-
-        respuesta = cliente_openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role":
-                "system",
-                "content":
-                """Analizá el mensaje y extraé información PERSONAL/HUMANA que sirva para generar vínculo con el cliente.
-
-NO extraer datos comerciales (eso ya está en Cianbox).
-SÍ extraer cosas personales que un vendedor recordaría:
-
-- Salud: si menciona médico, enfermedad, dolor, accidente (propio o familia)
-- Familia: si menciona hijos, esposa, padres, hermanos
-- Planes: viajes, vacaciones, fin de semana
-- Hobbies: pesca, fútbol, deportes, actividades
-- Trabajo: proyectos en curso, obras, clientes suyos
-- Estado de ánimo: si está apurado, estresado, contento
-- Cualquier dato personal que sirva para preguntar después
-
-Respondé SOLO con JSON:
-{
-    "evento": "descripción breve de lo que mencionó",
-    "tipo": "salud|familia|planes|hobby|trabajo|otro",
-    "seguimiento": "pregunta para hacer en próxima conversación"
-}
-
-Si no hay nada personal, respondé {}
-
-Ejemplos:
-- "estoy en el médico con mi viejo" → {"evento": "padre enfermo, en médico", "tipo": "familia", "seguimiento": "¿Cómo sigue tu viejo?"}
-- "el finde me voy a pescar" → {"evento": "va a pescar el fin de semana", "tipo": "hobby", "seguimiento": "¿Pudiste ir a pescar?"}
-- "estoy terminando una obra en funes" → {"evento": "obra en Funes en curso", "tipo": "trabajo", "seguimiento": "¿Cómo va la obra en Funes?"}"""
-            }, {
-                "role": "user",
-                "content": texto
-            }],
-            temperature=0.1)
-
-        contenido = respuesta.choices[0].message.content.strip()
-        contenido = contenido.replace('```json', '').replace('```', '').strip()
-
-        nuevo_evento = json.loads(contenido)
-
-        if nuevo_evento and nuevo_evento.get('evento'):
-            # Agregar timestamp
-            nuevo_evento['fecha'] = datetime.utcnow().isoformat()
-
-            # Agregar a la memoria (máximo 10 eventos)
-            memoria.append(nuevo_evento)
-            if len(memoria) > 10:
-                memoria = memoria[-10:]
-
-            datos['memoria_conversaciones'] = memoria
-            print(f'📝 Evento personal guardado: {nuevo_evento["evento"]}')
-
-        return datos
-
-    except Exception as e:
-        print(f'⚠️ Error extrayendo datos personales: {e}')
-        return datos_actuales or {}
-
-
 def actualizar_datos_cliente(telefono, datos_personales):
     """Actualiza los datos personales del cliente en MongoDB"""
     try:
@@ -861,6 +1264,7 @@ def actualizar_datos_cliente(telefono, datos_personales):
         print(f'❌ Error actualizando datos cliente: {e}')
 
 
+
 def formatear_contexto_cliente(cliente, datos_cianbox=None):
     """Formatea los datos del cliente para incluir en el prompt"""
     if not cliente and not datos_cianbox:
@@ -936,7 +1340,7 @@ def buscar_en_api_productos(termino_busqueda):
             'Oferta': 'false'
         }
 
-        response = requests.get(url, params=params, timeout=15)
+        response = requests.get(url, params=params, timeout=timeout_para(15))
 
         if response.status_code == 200:
             data = response.json()
@@ -1023,89 +1427,48 @@ def formatear_producto_para_respuesta(producto):
 def buscar_alternativas_producto(termino_original, cantidad=3):
     """
     Busca alternativas CON STOCK cuando el producto buscado no tiene.
-    Prioriza productos con características similares (resolución, tipo).
+    Prioriza productos con características similares (marca, forma,
+    resolución), usando las facetas calculadas al sincronizar.
     """
     try:
-        import re
         termino_lower = termino_original.lower()
 
-        # Extraer características del término original
-        resolucion_pedida = None
-        match_res = re.search(r'(\d+)\s*mp', termino_lower)
-        if match_res:
-            resolucion_pedida = int(match_res.group(1))
-
-        # Detectar tipo de producto
-        tipos = ['camara', 'domo', 'bullet', 'ptz', 'turret', 'dvr',
-                 'nvr', 'sensor', 'alarma', 'kit', 'hub', 'teclado',
-                 'sirena', 'disco', 'fuente', 'switch', 'cable', 'balun']
-
-        tipo_encontrado = None
-        for tipo in tipos:
-            if tipo in termino_lower:
-                tipo_encontrado = tipo
-                break
+        # Facetas del término pedido ("domo hikvision 4mp")
+        pedidas = extraer_facetas(termino_lower)
+        tipo_encontrado = pedidas['tipo']
 
-        # Detectar marca
-        marcas = ['hikvision', 'dahua', 'ajax', 'dsc', 'intelbras',
-                  'ubiquiti', 'tiandy', 'cygnus', 'zkteco']
-        marca_encontrada = None
-        for marca in marcas:
-            if marca in termino_lower:
-                marca_encontrada = marca
-                break
+        # Ranking precalculado por combinación de facetas
+        indice = catalogo.indice
+        if tipo_encontrado and indice is not None:
+            return [
+                producto_desde_catalogo(alt)
+                for alt in indice.alternativas_para_facetas(
+                    pedidas, cantidad, excluir=termino_lower)
+            ]
 
-        # Construir término de búsqueda
         if tipo_encontrado:
-            termino_busqueda = tipo_encontrado
-            if marca_encontrada:
-                termino_busqueda = f"{marca_encontrada} {tipo_encontrado}"
+            candidatos = buscar_por_facetas(tipo=tipo_encontrado)
         else:
-            termino_busqueda = termino_original
-
-        # Buscar alternativas con stock
-        alternativas = buscar_productos_cache(termino_busqueda,
-                                              solo_con_stock=True)
-
-        if not alternativas and tipo_encontrado:
-            # Buscar solo por tipo si no hay con marca
-            alternativas = buscar_productos_cache(tipo_encontrado,
-                                                  solo_con_stock=True)
+            # Sin tipo reconocible: búsqueda de texto
+            candidatos = [{
+                'nombre': alt.get('nombre', alt.get('name', '')),
+                'facetas': alt.get('facetas') or extraer_facetas(
+                    alt.get('nombre', alt.get('name', '')), alt.get('marca')),
+                'producto': alt
+            } for alt in buscar_productos_cache(termino_original,
+                                                solo_con_stock=True)]
 
         # Filtrar y ordenar por similitud
         alternativas_puntuadas = []
-        for alt in alternativas:
-            nombre_alt = alt.get('nombre', alt.get('name', '')).lower()
-
+        for candidato in candidatos:
             # No incluir el producto original
-            if termino_lower in nombre_alt:
+            if termino_lower in candidato['nombre'].lower():
                 continue
 
-            puntuacion = 0
-
-            # Bonus por misma marca
-            if marca_encontrada and marca_encontrada in nombre_alt:
-                puntuacion += 10
-
-            # Bonus por mismo tipo
-            if tipo_encontrado and tipo_encontrado in nombre_alt:
-                puntuacion += 5
-
-            # Bonus por resolución cercana
-            if resolucion_pedida:
-                match_alt = re.search(r'(\d+)\s*mp', nombre_alt)
-                if match_alt:
-                    res_alt = int(match_alt.group(1))
-                    # Priorizar resolución más cercana (preferir mayor)
-                    diff = abs(res_alt - resolucion_pedida)
-                    if res_alt >= resolucion_pedida:
-                        puntuacion += max(0, 10 - diff)
-                    else:
-                        puntuacion += max(0, 5 - diff)
-
-            alternativas_puntuadas.append((puntuacion, alt))
+            puntuacion = similitud_alternativa(pedidas, candidato['facetas'])
+            alternativas_puntuadas.append((puntuacion, candidato['producto']))
 
-        # Ordenar por puntuación descendente
+        # Ordenar por puntuación descendente (estable: a igual puntaje, más stock)
         alternativas_puntuadas.sort(key=lambda x: x[0], reverse=True)
 
         # Retornar las mejores alternativas
@@ -1116,6 +1479,62 @@ def buscar_alternativas_producto(termino_original, cantidad=3):
         return []
 
 
+def buscar_alternativas_de_producto(producto, cantidad=3):
+    """
+    Alternativas CON stock de un producto sin stock del catálogo:
+    lectura directa de las alternativas precalculadas al sincronizar.
+    """
+    indice = catalogo.indice
+    if indice is not None:
+        alternativas = indice.alternativas_de_producto(
+            producto.get('codigo', producto.get('sku', '')), cantidad)
+        if alternativas is not None:
+            return [producto_desde_catalogo(alt) for alt in alternativas]
+
+    return buscar_alternativas_producto(
+        producto.get('nombre', producto.get('name', '')), cantidad=cantidad)
+
+
+def producto_desde_catalogo(p):
+    """
+    Producto del índice o documento de productos_cache → ProductoCatalogo
+    (se lee igual que los dicts de la API: get('name'), get('precio')...).
+    Siempre es una copia: quien llama la puede modificar.
+    """
+    if isinstance(p, ProductoCatalogo):
+        return p.copiar()
+    return ProductoCatalogo.desde_documento(p)
+
+
+def buscar_por_facetas(limite=50, **facetas):
+    """
+    Productos CON stock que tienen esas facetas (ej: tipo='camara'),
+    ordenados por stock: en el índice en memoria o, si no está, con los
+    índices de facetas de MongoDB.
+    Retorna [{'nombre', 'facetas', 'producto'}, ...].
+    """
+    indice = catalogo.indice
+    if indice is not None:
+        documentos = indice.filtrar(con_stock=True, **facetas)[:limite]
+    elif db is not None and catalogo.listo():
+        filtro = {
+            f'facetas.{campo}': valor
+            for campo, valor in facetas.items() if valor is not None
+        }
+        filtro['stock'] = {'$gt': 0}
+        documentos = list(db['productos_cache'].find(
+            filtro, PROYECCION_CATALOGO).sort(
+            'stock', -1).limit(limite))
+    else:
+        return []
+
+    return [{
+        'nombre': doc.get('nombre', ''),
+        'facetas': doc.get('facetas') or {},
+        'producto': producto_desde_catalogo(doc)
+    } for doc in documentos]
+
+
 def formatear_alternativas(alternativas):
     """Formatea las alternativas para mostrar al cliente"""
     if not alternativas:
@@ -1360,6 +1779,308 @@ def actualizar_fecha_nacimiento(telefono, fecha):
         print(f'❌ Error actualizando fecha nacimiento: {e}')
 
 
+# Esquema JSON estricto para el análisis del mensaje (structured outputs)
+ESQUEMA_ANALISIS_MENSAJE = {
+    'name': 'analisis_mensaje',
+    'strict': True,
+    'schema': {
+        'type':
+        'object',
+        'additionalProperties':
+        False,
+        'required': [
+            'productos', 'evento_personal', 'marcas', 'proveedores',
+            'preferencia_promos', 'fecha_nacimiento'
+        ],
+        'properties': {
+            'productos': {
+                'type': 'array',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'evento_personal': {
+                'anyOf': [{
+                    'type': 'null'
+                }, {
+                    'type': 'object',
+                    'additionalProperties': False,
+                    'required': ['evento', 'tipo', 'seguimiento'],
+                    'properties': {
+                        'evento': {
+                            'type': 'string'
+                        },
+                        'tipo': {
+                            'type':
+                            'string',
+                            'enum': [
+                                'salud', 'familia', 'planes', 'hobby',
+                                'trabajo', 'otro'
+                            ]
+                        },
+                        'seguimiento': {
+                            'type': 'string'
+                        }
+                    }
+                }]
+            },
+            'marcas': {
+                'type': 'array',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'proveedores': {
+                'type': 'array',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'preferencia_promos': {
+                'type': ['string', 'null'],
+                'enum': ['si', 'no', None]
+            },
+            'fecha_nacimiento': {
+                'anyOf': [{
+                    'type': 'null'
+                }, {
+                    'type': 'object',
+                    'additionalProperties': False,
+                    'required': ['dia', 'mes'],
+                    'properties': {
+                        'dia': {
+                            'type': 'integer'
+                        },
+                        'mes': {
+                            'type': 'integer'
+                        }
+                    }
+                }]
+            }
+        }
+    }
+}
+
+PROMPT_ANALISIS_MENSAJE = """Analizá el mensaje de un cliente de GRUPO SER (seguridad electrónica) y completá TODOS los campos.
+
+productos: términos de búsqueda de los productos mencionados (ej: "cámaras", "DVR 8 canales dahua", "sensores"). [] si no hay productos claros.
+
+evento_personal: información PERSONAL/HUMANA que un vendedor recordaría para generar vínculo. NO datos comerciales.
+- Salud: médico, enfermedad, dolor, accidente (propio o familia)
+- Familia: hijos, esposa, padres, hermanos
+- Planes: viajes, vacaciones, fin de semana
+- Hobbies: pesca, fútbol, deportes, actividades
+- Trabajo: proyectos en curso, obras, clientes suyos
+- Estado de ánimo: apurado, estresado, contento
+"evento" es una descripción breve, "seguimiento" la pregunta para la próxima conversación. null si no hay nada personal.
+Ejemplos:
+- "estoy en el médico con mi viejo" → {"evento": "padre enfermo, en médico", "tipo": "familia", "seguimiento": "¿Cómo sigue tu viejo?"}
+- "el finde me voy a pescar" → {"evento": "va a pescar el fin de semana", "tipo": "hobby", "seguimiento": "¿Pudiste ir a pescar?"}
+- "estoy terminando una obra en funes" → {"evento": "obra en Funes en curso", "tipo": "trabajo", "seguimiento": "¿Cómo va la obra en Funes?"}
+
+marcas: marcas de productos que menciona (Hikvision, Dahua, Ajax, DSC, etc). [] si no hay.
+
+proveedores: otros proveedores/comercios donde compra (ej: Casa Munro, MercadoLibre, Syscom). [] si no hay.
+
+preferencia_promos: "si" si acepta recibir promos/capacitaciones, "no" si las rechaza, null si no dice nada.
+
+fecha_nacimiento: {"dia", "mes"} SOLO si menciona su fecha de nacimiento o cumpleaños. null si no."""
+
+
+# Caché de resultados de extracción con LLM: en memoria + MongoDB (TTL)
+cache_llm = CacheCompartido(
+    lambda: db['cache_llm'] if db is not None and os.environ.get(
+        'CACHE_LLM_COMPARTIDO', 'true').lower() == 'true' else None,
+    max_items=int(os.environ.get('CACHE_LLM_ITEMS', 5000)),
+    ttl_segundos=int(os.environ.get('CACHE_LLM_TTL_HORAS', 72)) * 60 * 60)
+metricas.registrar_fuente('cache_llm', cache_llm.metricas)
+
+
+def clave_cache_llm(prompt, texto, de_busqueda=True):
+    """
+    Clave de caché para una extracción con LLM: texto normalizado + versión
+    del prompt. La versión es un hash del prompt, así un cambio de prompt
+    invalida solo.
+    Con `de_busqueda` (prompts que solo extraen qué busca el cliente) el
+    texto pasa por normalizar_busqueda y pierde la puntuación; si no, solo
+    se ignoran mayúsculas, tildes y espacios (el resultado depende del
+    texto completo: eventos personales, fechas...).
+    """
+    import re
+    import unicodedata
+
+    if de_busqueda and NORMALIZADOR_DISPONIBLE:
+        texto_normalizado = normalizar_busqueda(texto)
+    else:
+        texto_normalizado = texto.lower().strip()
+    texto_normalizado = ''.join(
+        c for c in unicodedata.normalize('NFKD', texto_normalizado)
+        if not unicodedata.combining(c))
+    if de_busqueda:
+        texto_normalizado = re.sub(r'[¿?¡!.,;:"\']+', ' ', texto_normalizado)
+    texto_normalizado = ' '.join(texto_normalizado.split())
+
+    version = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:10]
+    return CacheCompartido.clave(version, texto_normalizado)
+
+
+def analizar_mensaje(texto):
+    """
+    Analiza el mensaje con UNA sola llamada a OpenAI con salida estructurada
+    (JSON schema estricto): productos, evento personal, marcas, proveedores,
+    preferencia de promos y fecha de nacimiento.
+    Los resultados se cachean por texto (sin mayúsculas, tildes ni
+    espacios de más).
+    Retorna el dict del análisis o None si falla.
+    """
+    try:
+        # El análisis incluye datos personales: clave sobre el texto
+        # original, sin normalizar sinónimos ni códigos
+        clave = clave_cache_llm(
+            PROMPT_ANALISIS_MENSAJE + json.dumps(ESQUEMA_ANALISIS_MENSAJE),
+            texto,
+            de_busqueda=False)
+        analisis = cache_llm.obtener(clave)
+        if analisis is not NO_ENCONTRADO:
+            print('💾 Análisis desde caché')
+            return analisis
+
+        respuesta = cliente_openai.chat.completions.create(
+            timeout=timeout_para(15),
+            model="gpt-4o-mini",
+            messages=[{
+                "role": "system",
+                "content": PROMPT_ANALISIS_MENSAJE
+            }, {
+                "role": "user",
+                "content": texto
+            }],
+            temperature=0.1,
+            response_format={
+                'type': 'json_schema',
+                'json_schema': ESQUEMA_ANALISIS_MENSAJE
+            })
+
+        mensaje = respuesta.choices[0].message
+        if getattr(mensaje, 'refusal', None):
+            print(f'⚠️ Análisis rechazado por el modelo: {mensaje.refusal}')
+            return None
+
+        analisis = json.loads(mensaje.content)
+        cache_llm.guardar(clave, analisis)
+        return analisis
+
+    except Exception as e:
+        print(f'❌ Error analizando mensaje: {e}')
+        return None
+
+
+def analizar_mensaje_local(texto):
+    """
+    Análisis por reglas, mismo formato que analizar_mensaje.
+    Se usa cuando falla la llamada a OpenAI.
+    """
+    return {
+        'productos': [],
+        'evento_personal': None,
+        'marcas': detectar_marca_preferida(texto),
+        'proveedores': detectar_proveedor_mencionado(texto),
+        'preferencia_promos': detectar_preferencia_promos(texto),
+        'fecha_nacimiento': detectar_fecha_nacimiento(texto)
+    }
+
+
+def agregar_evento_memoria(telefono, evento):
+    """
+    Agrega un evento personal a datos_personales.memoria_conversaciones
+    (máximo 10) con $push atómico: dos mensajes seguidos del mismo
+    cliente no se pisan los eventos.
+    """
+    try:
+        if db is None:
+            return
+
+        # $push no puede crear el campo si datos_personales quedó en null
+        db['clientes'].update_one(
+            {
+                'telefono': telefono,
+                'datos_personales': {
+                    '$not': {
+                        '$type': 'object'
+                    }
+                }
+            }, {'$set': {
+                'datos_personales': {}
+            }})
+
+        db['clientes'].update_one({'telefono': telefono}, {
+            '$push': {
+                'datos_personales.memoria_conversaciones': {
+                    '$each': [{
+                        **evento, 'fecha': datetime.utcnow().isoformat()
+                    }],
+                    '$slice': -10
+                }
+            },
+            '$set': {
+                'actualizado': datetime.utcnow()
+            }
+        })
+        print(f'📝 Evento personal guardado: {evento["evento"]}')
+
+    except Exception as e:
+        print(f'❌ Error guardando evento personal: {e}')
+
+
+def guardar_memoria_cliente(telefono, analisis):
+    """
+    Guarda en MongoDB lo que el análisis del mensaje aprendió del cliente:
+    evento personal, marcas, proveedores, promos y fecha de nacimiento.
+    Corre en segundo plano: la respuesta no depende de esto. Cada dato se
+    escribe con un update atómico ($push, $addToSet, $set de campos
+    sueltos), nunca reescribiendo el documento leído al empezar el turno.
+    """
+    try:
+        # Evento personal → memoria de conversaciones (máximo 10 eventos)
+        evento = analisis.get('evento_personal')
+        if evento and evento.get('evento'):
+            agregar_evento_memoria(telefono, evento)
+
+        marcas = [m.strip().capitalize() for m in analisis.get('marcas', [])]
+        if marcas:
+            actualizar_marcas_cliente(telefono, marcas)
+
+        proveedores = [
+            p.strip().title() for p in analisis.get('proveedores', [])
+        ]
+        if proveedores:
+            actualizar_proveedores_cliente(telefono, proveedores)
+
+        if analisis.get('preferencia_promos'):
+            actualizar_preferencia_promos(telefono,
+                                          analisis['preferencia_promos'])
+
+        fecha = analisis.get('fecha_nacimiento')
+        if fecha and 1 <= fecha.get('dia', 0) <= 31 and 1 <= fecha.get(
+                'mes', 0) <= 12:
+            actualizar_fecha_nacimiento(telefono, fecha)
+
+    except Exception as e:
+        print(f'❌ Error guardando memoria del cliente: {e}')
+
+
+def guardar_memoria_de_analisis(telefono, texto, futuro):
+    """
+    Callback del análisis del mensaje: guarda la memoria con su resultado,
+    o con el análisis por reglas si falló o se canceló (así un turno sin
+    respuesta de OpenAI no pierde la fecha de nacimiento o las marcas).
+    """
+    analisis = None
+    if not futuro.cancelled() and futuro.exception() is None:
+        analisis = futuro.result()
+    guardar_memoria_cliente(telefono, analisis or analizar_mensaje_local(texto))
+
+
 def obtener_comportamiento_pago(cliente):
     """
     Obtiene el comportamiento de pago del cliente desde Cianbox.
@@ -1536,7 +2257,7 @@ def crear_presupuesto(telefono, nombre_cliente, items, validez_dias=15):
 
             response = requests.post(f'{ISR_API_URL}/api/presupuestos',
                                      json=isr_data,
-                                     timeout=10)
+                                     timeout=timeout_para(10))
 
             if response.status_code == 200:
                 print(f'✅ Presupuesto #{numero} sincronizado con ISR')
@@ -1994,34 +2715,6 @@ def verificar_stock_producto(nombre_producto):
     return False
 
 
-def extraer_productos_del_mensaje(texto):
-    try:
-        respuesta = cliente_openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role":
-                "system",
-                "content":
-                """Extraé los productos mencionados en el mensaje.
-                    Respondé SOLO con un JSON array de strings con términos de búsqueda.
-                    Si no hay productos claros, respondé [].
-                    Ejemplos: cámaras, DVR, NVR, sensores, alarmas, cables, fuentes."""
-            }, {
-                "role": "user",
-                "content": texto
-            }],
-            temperature=0.1)
-
-        contenido = respuesta.choices[0].message.content.strip()
-        contenido = contenido.replace('```json', '').replace('```', '').strip()
-        productos = json.loads(contenido)
-        return productos if isinstance(productos, list) else []
-
-    except Exception as e:
-        print(f'❌ Error extrayendo productos: {e}')
-        return []
-
-
 def extraer_productos_de_historial(historial):
     """Extrae productos del historial para armar presupuesto"""
     try:
@@ -2038,6 +2731,7 @@ def extraer_productos_de_historial(historial):
         print(f'📜 Historial para análisis:\n{texto_historial[:500]}...')
 
         respuesta = cliente_openai.chat.completions.create(
+            timeout=timeout_para(30),
             model="gpt-4o-mini",
             messages=[{
                 "role":
@@ -2168,30 +2862,20 @@ def evaluar_busqueda_consultiva(productos_encontrados, mensaje_usuario):
 
     for prod in productos_encontrados:
         marca = prod.get('marca', '')
-        nombre = prod.get('nombre', '').lower()
 
         if marca:
             marcas.add(marca)
 
-        # Detectar tipos
-        if 'domo' in nombre:
-            tipos.add('domo')
-        if 'bullet' in nombre:
-            tipos.add('bullet')
-        if 'ptz' in nombre:
-            tipos.add('ptz')
-        if 'turret' in nombre:
-            tipos.add('turret')
-        if 'interior' in nombre:
-            tipos.add('interior')
-        if 'exterior' in nombre:
-            tipos.add('exterior')
-        if '2mp' in nombre or '1080' in nombre:
-            tipos.add('2MP')
-        if '4mp' in nombre or '2k' in nombre:
-            tipos.add('4MP')
-        if '8mp' in nombre or '4k' in nombre:
-            tipos.add('8MP')
+        # Tipos a partir de las facetas calculadas al sincronizar
+        # (los productos de la API externa no las traen)
+        facetas = prod.get('facetas') or extraer_facetas(
+            prod.get('nombre', ''), marca)
+        if facetas.get('forma'):
+            tipos.add(facetas['forma'])
+        if facetas.get('ubicacion'):
+            tipos.add(facetas['ubicacion'])
+        if facetas.get('resolucion_mp'):
+            tipos.add(f"{facetas['resolucion_mp']}MP")
 
     # Decidir qué preguntar
     if len(productos_encontrados) > 5:
@@ -2207,6 +2891,87 @@ def evaluar_busqueda_consultiva(productos_encontrados, mensaje_usuario):
     return resultado
 
 
+# Tiers de modelo para generar respuestas (configurables por entorno)
+TIERS_MODELO = {
+    'rapido': os.environ.get('MODELO_TIER_RAPIDO', 'gpt-4o-mini'),
+    'completo': os.environ.get('MODELO_TIER_COMPLETO', 'gpt-4')
+}
+
+# Qué tier usa cada tipo de turno
+TIER_POR_TURNO = {
+    'saludo': 'rapido',
+    'disponibilidad': 'rapido',
+    'tecnico': 'completo',
+    'presupuesto': 'completo'
+}
+
+# Precio estimado en USD por millón de tokens (entrada, salida)
+PRECIOS_MODELOS = {
+    'gpt-4': (30.0, 60.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6)
+}
+
+
+def clasificar_turno(mensaje_usuario,
+                     productos_encontrados=None,
+                     presupuesto_texto=None,
+                     info_stock_cantidad=None):
+    """
+    Clasifica el turno para elegir el modelo:
+    saludo, disponibilidad ("tenés X?"), tecnico (comparación/pregunta
+    técnica) o presupuesto (cantidades y cotizaciones).
+    """
+    texto_lower = mensaje_usuario.lower()
+
+    if presupuesto_texto or info_stock_cantidad or 'presupuesto' in texto_lower:
+        return 'presupuesto'
+
+    palabras_tecnicas = [
+        'diferencia', 'compar', 'mejor', 'conviene', 'recomend', 'cual',
+        'cuál', 'sirve para', 'funciona', 'instal', 'configur', 'compatible',
+        'alcance', 'distancia', 'resoluci', 'vision nocturna',
+        'visión nocturna', 'especificaci', 'por que', 'por qué', ' vs ',
+        'versus', 'cuantas camaras', 'cuántas cámaras', 'cuantos dias',
+        'cuántos días'
+    ]
+    if any(palabra in texto_lower for palabra in palabras_tecnicas):
+        return 'tecnico'
+
+    if productos_encontrados:
+        return 'disponibilidad'
+
+    if not detectar_intencion_compra(mensaje_usuario):
+        return 'saludo'
+
+    return 'tecnico'
+
+
+def elegir_modelo(tipo_turno, tier_forzado=None):
+    """
+    Retorna (tier, modelo) para el tipo de turno.
+    FORZAR_TIER_MODELO (entorno) o tier_forzado pisan la clasificación.
+    """
+    tier = tier_forzado or os.environ.get('FORZAR_TIER_MODELO') or \
+        TIER_POR_TURNO.get(tipo_turno, 'completo')
+    if tier not in TIERS_MODELO:
+        tier = 'completo'
+    return tier, TIERS_MODELO[tier]
+
+
+def registrar_uso_modelo(tier, modelo, respuesta, segundos):
+    """Cuenta llamadas, latencia y costo estimado por tier"""
+    metricas.incrementar(f'modelo.{tier}.llamadas')
+    metricas.observar(f'modelo.{tier}.latencia_segundos', segundos)
+
+    uso = getattr(respuesta, 'usage', None)
+    precio = PRECIOS_MODELOS.get(modelo)
+    if uso and precio:
+        costo = (uso.prompt_tokens * precio[0] +
+                 uso.completion_tokens * precio[1]) / 1_000_000
+        metricas.incrementar(f'modelo.{tier}.costo_usd', costo)
+
+
 def generar_respuesta_con_contexto(mensaje_usuario,
                                    historial,
                                    nombre_cliente,
@@ -2215,7 +2980,8 @@ def generar_respuesta_con_contexto(mensaje_usuario,
                                    info_cliente=None,
                                    cliente_mongo=None,
                                    es_verificado=True,
-                                   info_stock_cantidad=None):
+                                   info_stock_cantidad=None,
+                                   tier_forzado=None):
     try:
         # Preparar contexto de productos (solo para que GPT sepa qué hay)
         contexto_productos = ""
@@ -2369,8 +3135,17 @@ Historial: {historial_texto if historial_texto else 'Primera conversación'}
 {contexto_presupuesto}
 {f"Info: {contexto_cliente}" if contexto_cliente else ""}"""
 
+        # Elegir modelo según el tipo de turno
+        tipo_turno = clasificar_turno(mensaje_usuario, productos_encontrados,
+                                      presupuesto_texto, info_stock_cantidad)
+        tier, modelo = elegir_modelo(tipo_turno, tier_forzado)
+        print(f'🧠 Turno "{tipo_turno}" → {modelo} ({tier})', flush=True)
+        metricas.incrementar(f'turno.{tipo_turno}')
+
+        inicio = time_module.time()
         respuesta = cliente_openai.chat.completions.create(
-            model="gpt-4",
+            timeout=timeout_para(30),
+            model=modelo,
             messages=[{
                 "role": "system",
                 "content": mensajes_sistema
@@ -2381,6 +3156,8 @@ Historial: {historial_texto if historial_texto else 'Primera conversación'}
             temperature=0.7,
             max_tokens=150
         )
+        registrar_uso_modelo(tier, modelo, respuesta,
+                             time_module.time() - inicio)
 
         respuesta_texto = respuesta.choices[0].message.content
 
@@ -2394,6 +3171,8 @@ Historial: {historial_texto if historial_texto else 'Primera conversación'}
         return respuesta_texto
 
     except Exception as e:
+        if es_error_de_plazo(e):
+            raise
         print(f'❌ Error generando respuesta: {e}')
         return f"Hola {nombre_cliente}, disculpá, tuve un problema. ¿Podés repetirme?"
 
@@ -2414,26 +3193,97 @@ def verificar_webhook():
     return 'Error', 403
 
 
+# Presupuesto de tiempo de cada mensaje, desde que el webhook lo acepta.
+# La reserva queda para mandar la respuesta (o la de emergencia).
+PLAZO_MENSAJE_SEGUNDOS = float(os.environ.get('PLAZO_MENSAJE_SEGUNDOS', 45))
+PLAZO_RESERVA_SEGUNDOS = float(os.environ.get('PLAZO_RESERVA_SEGUNDOS', 5))
+
+MENSAJE_PLAZO_AGOTADO = ("Disculpá, se me demoró la consulta. "
+                         "¿Me la repetís en un ratito? 🙏")
+
+
+def extraer_mensajes_webhook(body):
+    """
+    Recorre TODAS las entries, changes y messages de un webhook de WhatsApp.
+    Meta agrupa varios mensajes en un solo POST cuando hay carga.
+    Retorna una lista de tareas listas para encolar.
+    """
+    tareas = []
+    ahora = time_module.time()
+
+    for entry in body.get('entry', []):
+        for change in entry.get('changes', []):
+            value = change.get('value', {})
+            contactos = value.get('contacts', [])
+
+            for mensaje in value.get('messages', []):
+                remitente = mensaje.get('from')
+                texto = mensaje.get('text', {}).get('body', '')
+
+                if not remitente or not texto:
+                    continue
+
+                # Dejar solo el contacto y el mensaje de este remitente
+                contacto = [
+                    c for c in contactos if c.get('wa_id') == remitente
+                ] or contactos[:1]
+
+                tareas.append({
+                    'mensaje_id': mensaje.get('id'),
+                    'remitente': remitente,
+                    'texto': texto,
+                    'value': {
+                        **value, 'contacts': contacto,
+                        'messages': [mensaje]
+                    },
+                    'recibido': ahora,
+                    'plazo': Plazo(PLAZO_MENSAJE_SEGUNDOS,
+                                   PLAZO_RESERVA_SEGUNDOS,
+                                   inicio=ahora)
+                })
+
+    return tareas
+
+
 @app.route('/webhook', methods=['POST'])
 def recibir_mensaje():
     try:
         body = request.get_json()
 
         if body.get('object') == 'whatsapp_business_account':
-            entry = body.get('entry', [{}])[0]
-            changes = entry.get('changes', [{}])[0]
-            value = changes.get('value', {})
-
-            if 'messages' in value:
-                mensaje = value['messages'][0]
-                remitente = mensaje.get('from')
-                texto = mensaje.get('text', {}).get('body', '')
-
-                if texto:
-                    print(f'\n{"="*50}', flush=True)
-                    print(f'📩 Mensaje de {remitente}: {texto}', flush=True)
-                    print(f'{"="*50}', flush=True)
-                    procesar_mensaje(remitente, texto, value)
+            tareas = extraer_mensajes_webhook(body)
+
+            metricas.observar('webhook.mensajes_por_entrega', len(tareas))
+
+            # Descartar reintentos de Meta (mismo id de mensaje)
+            ids = [t['mensaje_id'] for t in tareas if t['mensaje_id']]
+            nuevos = deduplicador_mensajes.registrar_lote(ids)
+            duplicados = len(ids) - len(nuevos)
+            if duplicados:
+                print(f'♻️ {duplicados} mensajes duplicados descartados')
+                metricas.incrementar('webhook.duplicados', duplicados)
+            tareas = [
+                t for t in tareas
+                if not t['mensaje_id'] or t['mensaje_id'] in nuevos
+            ]
+
+            if tareas:
+                print(f'\n{"="*50}', flush=True)
+                for tarea in tareas:
+                    print(f'📩 Mensaje de {tarea["remitente"]}: {tarea["texto"]}',
+                          flush=True)
+                print(f'{"="*50}', flush=True)
+
+                # Encolar todo el lote y responder al instante: Meta reintenta si tardamos
+                encolado = cola_entrantes.encolar_lote([
+                    (tarea['remitente'], tarea) for tarea in tareas
+                ])
+                if not encolado:
+                    print('⚠️ Cola de mensajes llena, Meta reintentará')
+                    deduplicador_mensajes.olvidar(nuevos)
+                    return jsonify({'status': 'busy'}), 503
+
+                metricas.incrementar('webhook.mensajes', len(tareas))
 
         return jsonify({'status': 'ok'}), 200
 
@@ -2655,8 +3505,38 @@ def procesar_mensaje(remitente, texto, value):
             productos_encontrados = []
             info_stock_cantidad = None
 
+            # Camino rápido: si el extractor local reconoce todo el mensaje
+            # (ej: "dvr 8 canales dahua"), no hay nada personal ni ambiguo
+            # y no hace falta llamar a OpenAI
+            if NORMALIZADOR_DISPONIBLE:
+                terminos_locales, confianza = extraer_terminos_locales(texto)
+            else:
+                terminos_locales, confianza = [], 0.0
+
+            if confianza >= UMBRAL_CONFIANZA_LOCAL:
+                print(f'⚡ Extractor local ({confianza:.2f}): {terminos_locales}',
+                      flush=True)
+                metricas.incrementar('extractor.local')
+                futuro_analisis = None
+                executor_llm.submit(guardar_memoria_cliente, remitente,
+                                    analizar_mensaje_local(texto))
+            else:
+                metricas.incrementar('extractor.llm')
+
+                # Un solo análisis estructurado del mensaje (productos + memoria),
+                # en paralelo mientras seguimos
+                futuro_analisis = enviar_con_plazo(executor_llm,
+                                                   analizar_mensaje, texto)
+
+                # La memoria del cliente no afecta la respuesta: se guarda
+                # en segundo plano cuando termine el análisis
+                futuro_analisis.add_done_callback(
+                    lambda futuro: guardar_memoria_de_analisis(
+                        remitente, texto, futuro))
+
             # Verificar si el cliente está indicando una CANTIDAD
             cantidad_solicitada = detectar_cantidad_solicitada(texto)
+
             if cantidad_solicitada:
                 print(f'🔢 Cantidad detectada: {cantidad_solicitada}', flush=True)
 
@@ -2687,7 +3567,7 @@ def procesar_mensaje(remitente, texto, value):
                         elif stock_real == 0:
                             info_stock_cantidad['mensaje'] = "No tenemos stock de este producto"
                             # Buscar alternativas
-                            alternativas = buscar_alternativas_producto(termino_busqueda, cantidad=2)
+                            alternativas = buscar_alternativas_de_producto(info_prod, cantidad=2)
                             if alternativas:
                                 info_stock_cantidad['alternativas'] = alternativas
 
@@ -2695,7 +3575,20 @@ def procesar_mensaje(remitente, texto, value):
 
             if detectar_intencion_compra(texto) and not cantidad_solicitada:
                 print(f'🔍 Buscando productos...', flush=True)
-                terminos = extraer_productos_del_mensaje(texto)
+                if futuro_analisis is None:
+                    terminos = terminos_locales
+                else:
+                    try:
+                        analisis = futuro_analisis.result(
+                            timeout=timeout_para(30))
+                        terminos = analisis['productos'] if analisis else []
+                    except FuturoTimeout:
+                        # El análisis tarda pero el plazo sigue: se responde
+                        # con los términos locales (o el texto, más abajo)
+                        print(f'⏱️ Análisis sin respuesta a tiempo, términos '
+                              f'locales: {terminos_locales}', flush=True)
+                        metricas.incrementar('extractor.timeout')
+                        terminos = terminos_locales
                 print(f'🔍 Términos: {terminos}', flush=True)
 
                 # Si GPT no extrajo términos, usar el texto original
@@ -2706,9 +3599,13 @@ def procesar_mensaje(remitente, texto, value):
                 productos_sin_stock = []
                 alternativas_encontradas = []
 
+                # Todos los términos juntos (solo productos CON stock);
+                # los que van a la API externa se buscan en paralelo
+                resultados_por_termino = buscar_productos_lote(
+                    terminos, solo_con_stock=True)
+
                 for termino in terminos:
-                    # Buscar solo productos CON stock
-                    resultados = buscar_productos_cache(termino, solo_con_stock=True)
+                    resultados = resultados_por_termino[termino]
 
                     # Si no hay con stock, buscar alternativas
                     if not resultados:
@@ -2728,8 +3625,7 @@ def procesar_mensaje(remitente, texto, value):
                         if stock <= 0:
                             productos_sin_stock.append(prod)
                             # Buscar alternativas
-                            alts = buscar_alternativas_producto(
-                                prod.get('nombre', prod.get('name', '')), cantidad=3)
+                            alts = buscar_alternativas_de_producto(prod, cantidad=3)
                             alternativas_encontradas.extend(alts)
 
                 # Si hay productos sin stock, notificar a compras
@@ -2742,38 +3638,10 @@ def procesar_mensaje(remitente, texto, value):
                         notificar_compras_sin_stock(nombre_prod, nombre,
                                                     remitente, historial_conv)
 
-                # Detectar marcas mencionadas
-                marcas_detectadas = detectar_marca_preferida(texto)
-                if marcas_detectadas:
-                    actualizar_marcas_cliente(remitente, marcas_detectadas)
-
-                # Detectar proveedores mencionados
-                proveedores_detectados = detectar_proveedor_mencionado(texto)
-                if proveedores_detectados:
-                    actualizar_proveedores_cliente(remitente,
-                                                   proveedores_detectados)
-
-                # Detectar preferencia de promos
-                pref_promos = detectar_preferencia_promos(texto)
-                if pref_promos:
-                    actualizar_preferencia_promos(remitente, pref_promos)
-
-                # Detectar fecha de nacimiento
-                fecha_nac = detectar_fecha_nacimiento(texto)
-                if fecha_nac:
-                    actualizar_fecha_nacimiento(remitente, fecha_nac)
-
                 # Agregar alternativas a productos encontrados
                 if alternativas_encontradas:
                     productos_encontrados.extend(alternativas_encontradas)
 
-            # Extraer y guardar datos personales de la conversación
-            datos_actuales = cliente.get('datos_personales',
-                                         {}) if cliente else {}
-            datos_personales = extraer_datos_personales(texto, datos_actuales)
-            if datos_personales and datos_personales != datos_actuales:
-                actualizar_datos_cliente(remitente, datos_personales)
-
             # Generar respuesta con contexto del cliente
             info_cliente = formatear_contexto_cliente(
                 cliente, datos_cianbox if es_cliente_verificado else None)
@@ -2804,11 +3672,81 @@ def procesar_mensaje(remitente, texto, value):
         guardar_conversacion(remitente, nombre, texto, respuesta)
 
     except Exception as e:
+        if es_error_de_plazo(e):
+            print(f'⏱️ Plazo agotado procesando mensaje de {remitente}: {e}')
+            # procesar_tarea_mensaje manda la respuesta de emergencia,
+            # fuera del plazo y del timeout de MongoDB
+            raise PlazoAgotado(str(e)) from e
+
         print(f'❌ Error procesando: {e}')
         import traceback
         traceback.print_exc()
 
 
+# ============== COLA DE MENSAJES ==============
+
+
+def procesar_tarea_mensaje(tarea):
+    """Procesa una tarea sacada de la cola de mensajes entrantes"""
+    espera = time_module.time() - tarea['recibido']
+    metricas.observar('cola.espera_segundos', espera)
+    metricas.observar('cola.mensajes_por_turno', tarea.get('agrupados', 1))
+
+    plazo = tarea.get('plazo')
+    if plazo is None:
+        procesar_mensaje(tarea['remitente'], tarea['texto'], tarea['value'])
+        return
+
+    # Todo lo que se llame adentro (Cianbox, API de productos, OpenAI,
+    # MongoDB y Graph API) toma su timeout de lo que queda del plazo
+    try:
+        with con_plazo(plazo), pymongo.timeout(max(plazo.restante(), 0.001)):
+            procesar_mensaje(tarea['remitente'], tarea['texto'],
+                             tarea['value'])
+    except PlazoAgotado:
+        # Fuera del plazo: la respuesta de emergencia tiene su propio timeout
+        metricas.incrementar('plazo.agotado')
+        enviar_mensaje_whatsapp(tarea['remitente'], MENSAJE_PLAZO_AGOTADO)
+
+    if plazo.restante(usar_reserva=True) < 0:
+        metricas.incrementar('plazo.excedido')
+    metricas.observar('plazo.restante_segundos', plazo.restante())
+
+
+def combinar_tareas_mensaje(tareas):
+    """
+    Une varios mensajes seguidos del mismo remitente en un solo turno.
+    Ej: "hola" / "tenés cámaras?" / "hikvision 4mp" → una sola consulta.
+    """
+    print(f'🧩 Agrupando {len(tareas)} mensajes de {tareas[0]["remitente"]}')
+    return {
+        'mensaje_id': tareas[-1].get('mensaje_id'),
+        'remitente': tareas[0]['remitente'],
+        'texto': ' '.join(t['texto'].strip() for t in tareas),
+        'value': tareas[-1]['value'],
+        'recibido': min(t['recibido'] for t in tareas),
+        'plazo': min((t['plazo'] for t in tareas if t.get('plazo')),
+                     key=lambda plazo: plazo.vence,
+                     default=None),
+        'agrupados': len(tareas)
+    }
+
+
+cola_entrantes = ColaPorRemitente(
+    procesar_tarea_mensaje,
+    workers=int(os.environ.get('WORKERS_MENSAJES', 8)),
+    max_pendientes=int(os.environ.get('MAX_COLA_MENSAJES', 2000)),
+    ventana_segundos=float(os.environ.get('VENTANA_AGRUPADO_SEGUNDOS', 3)),
+    ventana_maxima_segundos=float(
+        os.environ.get('VENTANA_AGRUPADO_MAX_SEGUNDOS', 10)),
+    combinar=combinar_tareas_mensaje)
+metricas.registrar_fuente('cola', cola_entrantes.metricas)
+
+deduplicador_mensajes = DeduplicadorMensajes(
+    lambda: db['mensajes_procesados'] if db is not None else None,
+    ttl_segundos=int(os.environ.get('TTL_DEDUPE_HORAS', 7 * 24)) * 60 * 60)
+
+
 def enviar_documento_whatsapp(destinatario,
                               ruta_archivo,
                               nombre_archivo,
@@ -2830,7 +3768,9 @@ def enviar_documento_whatsapp(destinatario,
             }
             response_upload = requests.post(url_upload,
                                             headers=headers,
-                                            files=files)
+                                            files=files,
+                                            timeout=timeout_para(
+                                                30, usar_reserva=True))
 
         if response_upload.status_code != 200:
             print(f'❌ Error subiendo PDF: {response_upload.text}')
@@ -2858,7 +3798,10 @@ def enviar_documento_whatsapp(destinatario,
             'Content-Type': 'application/json'
         }
 
-        response = requests.post(url_send, headers=headers_send, json=payload)
+        response = requests.post(url_send,
+                                 headers=headers_send,
+                                 json=payload,
+                                 timeout=timeout_para(15, usar_reserva=True))
         print(f'✅ Documento enviado a {destinatario}')
         return response.json()
 
@@ -2887,7 +3830,10 @@ def enviar_mensaje_whatsapp(destinatario, texto):
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(url,
+                                 headers=headers,
+                                 json=payload,
+                                 timeout=timeout_para(15, usar_reserva=True))
         print(f'✅ Mensaje enviado a {destinatario}')
         return response.json()
 
@@ -2936,7 +3882,10 @@ def enviar_plantilla_whatsapp(destinatario, nombre_plantilla, parametros):
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(url,
+                                 headers=headers,
+                                 json=payload,
+                                 timeout=timeout_para(15, usar_reserva=True))
 
         if response.status_code == 200:
             print(f'✅ Plantilla {nombre_plantilla} enviada a {destinatario}')
@@ -2952,6 +3901,9 @@ def enviar_plantilla_whatsapp(destinatario, nombre_plantilla, parametros):
         return None
 
 
+PROMPT_TEMA_CONSULTA = "Extraé el tema principal de consulta en máximo 5 palabras. Ejemplos: 'cámaras para la obra', 'alarma para el local', 'DVR 8 canales'. Si no hay tema claro, respondé 'tu consulta'."
+
+
 def obtener_tema_ultima_consulta(conversaciones):
     """
     Extrae el tema principal de la última consulta del cliente usando GPT.
@@ -2971,13 +3923,17 @@ def obtener_tema_ultima_consulta(conversaciones):
 
         texto = " | ".join(mensajes_usuario[-5:])
 
-        respuesta = cliente_openai.chat.completions.create(
+        clave = clave_cache_llm(PROMPT_TEMA_CONSULTA, texto)
+        tema = cache_llm.obtener(clave)
+        if tema is not NO_ENCONTRADO:
+            return tema
+
+        respuesta = cliente_openai_cron.chat.completions.create(
+            timeout=timeout_para(10),
             model="gpt-4o-mini",
             messages=[{
-                "role":
-                "system",
-                "content":
-                "Extraé el tema principal de consulta en máximo 5 palabras. Ejemplos: 'cámaras para la obra', 'alarma para el local', 'DVR 8 canales'. Si no hay tema claro, respondé 'tu consulta'."
+                "role": "system",
+                "content": PROMPT_TEMA_CONSULTA
             }, {
                 "role": "user",
                 "content": texto
@@ -2986,7 +3942,11 @@ def obtener_tema_ultima_consulta(conversaciones):
             max_tokens=20)
 
         tema = respuesta.choices[0].message.content.strip()
-        return tema if tema else "tu consulta"
+        if not tema:
+            return "tu consulta"
+
+        cache_llm.guardar(clave, tema)
+        return tema
 
     except Exception as e:
         print(f'❌ Error extrayendo tema: {e}')
@@ -3021,7 +3981,8 @@ def obtener_mensaje_personal_lunes(cliente):
         if not contexto.strip():
             return "¿Cómo estuvo el finde?"
 
-        respuesta = cliente_openai.chat.completions.create(
+        respuesta = cliente_openai_cron.chat.completions.create(
+            timeout=timeout_para(10),
             model="gpt-4o-mini",
             messages=[{
                 "role":
@@ -3280,6 +4241,56 @@ def health():
     return jsonify({'status': 'healthy', 'service': 'ovidio-bot'}), 200
 
 
+@app.route('/metricas')
+def metricas_endpoint():
+    """Métricas internas: cola de mensajes, contadores y latencias"""
+    return jsonify(metricas.obtener_metricas()), 200
+
+
+# Resultados máximos por variante en /explicar-busqueda
+MAX_LIMITE_EXPLICAR = 50
+
+
+@app.route('/explicar-busqueda')
+def explicar_busqueda_endpoint():
+    """
+    Ranking de productos del índice para ?q=..., con el desglose del
+    puntaje de cada uno (BM25, código, marca). Ej: /explicar-busqueda?q=dvr 8 canales
+    Por defecto solo productos con stock, como las búsquedas del bot
+    (?con_stock=false para ver todos).
+    """
+    termino = request.args.get('q', '')
+    indice = catalogo.indice
+    if indice is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Índice del catálogo no cargado'
+        }), 503
+
+    variantes = obtener_variantes_busqueda(
+        termino) if NORMALIZADOR_DISPONIBLE else [termino.lower().strip()]
+    try:
+        limite = int(request.args.get('limite', 10))
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'limite tiene que ser un número'
+        }), 400
+    limite = max(1, min(limite, MAX_LIMITE_EXPLICAR))
+    con_stock = request.args.get('con_stock', 'true').lower() not in ('false',
+                                                                     '0', 'no')
+
+    return jsonify({
+        'termino': termino,
+        'generacion': catalogo.generacion,
+        'variantes': [{
+            'variante': variante,
+            'resultados': indice.explicar(variante, limite=limite,
+                                          con_stock=con_stock)
+        } for variante in variantes]
+    }), 200
+
+
 @app.route('/sync-cianbox', methods=['POST'])
 def sync_cianbox_endpoint():
     """Endpoint para disparar sincronización manual de Cianbox"""
@@ -3324,14 +4335,18 @@ def sync_status():
 
 @app.route('/sync-productos', methods=['GET', 'POST'])
 def sync_productos_endpoint():
-    """Endpoint para disparar sincronización manual de productos"""
-    resultado = sincronizar_productos_cache()
+    """
+    Endpoint para disparar sincronización manual de productos
+    (?modo=incremental para escribir solo los cambios)
+    """
+    incremental = request.args.get('modo') == 'incremental'
+    resultado = sincronizar_productos_cache(incremental=incremental)
     if resultado:
-        count = db['productos_cache'].count_documents({}) if db else 0
         return jsonify({
             'status': 'ok',
             'message': 'Sincronización completada',
-            'productos': count
+            'productos': catalogo.estado['productos'],
+            'generacion': catalogo.generacion
         }), 200
     else:
         return jsonify({
@@ -3368,6 +4383,7 @@ def inicializacion_en_background():
                     sincronizar_productos_cache()
                 else:
                     print(f'📦 Caché con {productos_count} productos')
+                    cargar_catalogo_en_memoria()
                 iniciar_cron_productos()
             except Exception as e:
                 print(f'❌ Error inicializando productos: {e}')
@@ -3379,6 +4395,7 @@ def inicializacion_en_background():
 if __name__ == '__main__':
     limpiar_pdfs_viejos()
     conectar_mongodb()
+    cola_entrantes.iniciar()
     port = int(os.environ.get('PORT', 3000))
     print(f'🚀 Ovidio corriendo en puerto {port}')
     background_thread = threading.Thread(target=inicializacion_en_background,
@@ -0,0 +1,75 @@
+"""
+Métricas en memoria del bot (contadores, observaciones y fuentes).
+Se exponen por el endpoint /metricas.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_contadores = {}
+_observaciones = {}
+_fuentes = {}
+
+
+def incrementar(nombre, cantidad=1):
+    """Suma `cantidad` al contador `nombre`"""
+    with _lock:
+        _contadores[nombre] = _contadores.get(nombre, 0) + cantidad
+
+
+def observar(nombre, valor):
+    """
+    Registra un valor observado (latencia, tamaño de lote, etc).
+    Guarda cantidad, suma, mínimo, máximo y último valor.
+    """
+    with _lock:
+        obs = _observaciones.get(nombre)
+        if obs is None:
+            obs = {
+                'cantidad': 0,
+                'suma': 0,
+                'minimo': valor,
+                'maximo': valor,
+                'ultimo': valor
+            }
+            _observaciones[nombre] = obs
+
+        obs['cantidad'] += 1
+        obs['suma'] += valor
+        obs['minimo'] = min(obs['minimo'], valor)
+        obs['maximo'] = max(obs['maximo'], valor)
+        obs['ultimo'] = valor
+
+
+def registrar_fuente(nombre, funcion):
+    """
+    Registra una función que devuelve un dict con métricas al momento
+    de consultarlas (ej: profundidad de la cola).
+    """
+    with _lock:
+        _fuentes[nombre] = funcion
+
+
+def obtener_metricas():
+    """Devuelve un snapshot de todas las métricas"""
+    with _lock:
+        contadores = dict(_contadores)
+        observaciones = {}
+        for nombre, obs in _observaciones.items():
+            datos = dict(obs)
+            datos['promedio'] = obs['suma'] / obs['cantidad']
+            observaciones[nombre] = datos
+        fuentes = dict(_fuentes)
+
+    resultado = {
+        'contadores': contadores,
+        'observaciones': observaciones
+    }
+
+    for nombre, funcion in fuentes.items():
+        try:
+            resultado[nombre] = funcion()
+        except Exception as e:
+            resultado[nombre] = {'error': str(e)}
+
+    return resultado
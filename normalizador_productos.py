@@ -228,3 +228,121 @@ def obtener_variantes_busqueda(texto):
         variantes.append(norm_sin_esp)
 
     return variantes
+
+
+# ============== EXTRACTOR LOCAL DE TÉRMINOS ==============
+
+# Palabras que no aportan a la búsqueda (saludos, verbos de consulta, conectores)
+PALABRAS_VACIAS = {
+    'hola', 'buenas', 'buen', 'buenos', 'dia', 'día', 'dias', 'días',
+    'tardes', 'noches', 'gracias', 'ok', 'dale', 'che', 'hey', 'saludos',
+    'tenes', 'tenés', 'tienen', 'tiene', 'hay', 'quiero',
+    'queria', 'quería', 'necesito', 'busco', 'buscaba', 'precio',
+    'precios', 'cuanto', 'cuánto', 'sale', 'salen', 'cuesta', 'cuestan',
+    'valor', 'stock', 'disponible', 'consulta', 'consultar', 'pasame',
+    'pasás', 'pasas', 'me', 'podes', 'podés', 'por', 'favor', 'el', 'la',
+    'los', 'las', 'un', 'una', 'unos', 'unas', 'de', 'del', 'para', 'con',
+    'que', 'qué', 'a', 'al', 'en', 'y', 'e', 'o', 'algo', 'alguna',
+    'alguno', 'algun', 'algún', 'otra', 'otro', 'mas', 'más', 'si', 'sí'
+}
+
+# Atributos sueltos: suman confianza pero no identifican un producto solos
+PALABRAS_ATRIBUTO = {
+    'canales', 'canal', 'ch', 'mp', 'megapixel', 'megapixeles', 'tb', 'gb',
+    'pulgadas', 'metros', 'mts', 'interior', 'exterior', 'ip', 'poe',
+    'wifi', 'inalambrico', 'inalámbrico', 'cableado', 'audio', 'color'
+}
+
+PATRON_ATRIBUTO_NUMERICO = re.compile(
+    r'^\d+([.,]\d+)?(mp|tb|gb|ch|v|mm|m|mts|k|p|w)?$')
+
+# Códigos de producto: letras y números mezclados (ds-2ce16d0t, amt4010)
+PATRON_CODIGO = re.compile(r'^(?=.*\d)(?=.*[a-z])[a-z0-9\-\.]{4,}$')
+
+PATRON_SEPARADORES = re.compile(r'[,;+/\n]|\s+y\s+|\s+e\s+')
+
+PATRON_PALABRA = re.compile(r'[a-z0-9áéíóúñü][a-z0-9áéíóúñü\-\.]*')
+
+_vocabulario_catalogo = frozenset()
+
+
+def _vocabulario_base():
+    palabras = set()
+    for diccionario in (MARCAS_VARIANTES, PRODUCTOS_VARIANTES,
+                        CODIGOS_VARIANTES):
+        for correcto, variantes in diccionario.items():
+            palabras.add(correcto)
+            palabras.update(v for v in variantes if ' ' not in v)
+    return frozenset(palabras)
+
+
+VOCABULARIO_BASE = _vocabulario_base()
+
+
+def actualizar_vocabulario_catalogo(textos):
+    """
+    Carga las palabras del catálogo (nombres, códigos y marcas) para que
+    el extractor local las reconozca. Se llama al sincronizar productos.
+    """
+    global _vocabulario_catalogo
+    palabras = set()
+    for texto in textos:
+        for palabra in PATRON_PALABRA.findall((texto or '').lower()):
+            palabra = palabra.strip('.-')
+            if len(palabra) >= 2 and not palabra.isdigit(
+            ) and palabra not in PALABRAS_VACIAS:
+                palabras.add(palabra)
+    _vocabulario_catalogo = frozenset(palabras)
+    print(f'📚 Vocabulario del catálogo: {len(palabras)} palabras')
+
+
+def extraer_terminos_locales(texto):
+    """
+    Extrae términos de búsqueda sin LLM, usando los vocabularios de este
+    módulo más las palabras del catálogo.
+    Retorna (terminos, confianza): confianza es la fracción de palabras
+    reconocidas (1.0 si no hay nada que no sea saludo/conector).
+    """
+    reconocidas = 0
+    desconocidas = 0
+    terminos = []
+
+    for segmento in PATRON_SEPARADORES.split((texto or '').lower()):
+        palabras = [
+            p.strip('.-') for p in PATRON_PALABRA.findall(
+                normalizar_busqueda(segmento))
+        ]
+        utiles = []
+        tiene_ancla = False
+
+        for palabra in palabras:
+            if not palabra or palabra in PALABRAS_VACIAS:
+                continue
+            if palabra in PALABRAS_ATRIBUTO or PATRON_ATRIBUTO_NUMERICO.match(
+                    palabra):
+                pass
+            elif (palabra in VOCABULARIO_BASE
+                  or palabra in _vocabulario_catalogo
+                  or PATRON_CODIGO.match(palabra)):
+                tiene_ancla = True
+            else:
+                desconocidas += 1
+                continue
+            reconocidas += 1
+            utiles.append(palabra)
+
+        if not utiles:
+            continue
+
+        if tiene_ancla:
+            terminos.append(' '.join(utiles))
+        elif terminos:
+            # Atributos sueltos ("..., 4mp") completan el término anterior
+            terminos[-1] += ' ' + ' '.join(utiles)
+        else:
+            desconocidas += len(utiles)
+            reconocidas -= len(utiles)
+
+    total = reconocidas + desconocidas
+    confianza = reconocidas / total if total else 1.0
+    return terminos, confianza
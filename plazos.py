@@ -0,0 +1,89 @@
+"""
+Plazo (deadline) por mensaje.
+Se crea cuando el webhook acepta el mensaje y se propaga (vía contextvars)
+a todas las llamadas salientes: Cianbox, API de productos, OpenAI, MongoDB
+y Graph API. El tiempo restante define el timeout de cada llamada.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+
+class PlazoAgotado(Exception):
+    """No queda tiempo para hacer la llamada"""
+
+
+class Plazo:
+    """
+    Presupuesto de tiempo de un mensaje.
+    `reserva` son segundos guardados para poder mandar la respuesta
+    de emergencia cuando el resto del plazo se agotó.
+    """
+
+    def __init__(self, segundos, reserva=0, inicio=None):
+        self.inicio = inicio if inicio is not None else time.time()
+        self.vence = self.inicio + segundos
+        self.reserva = reserva
+
+    def restante(self, usar_reserva=False):
+        """Segundos que quedan (sin contar la reserva, salvo que se pida)"""
+        limite = self.vence if usar_reserva else self.vence - self.reserva
+        return limite - time.time()
+
+    def agotado(self):
+        return self.restante() <= 0
+
+
+_plazo_actual = contextvars.ContextVar('plazo_actual', default=None)
+
+
+def plazo_actual():
+    """Plazo del mensaje que se está procesando (o None)"""
+    return _plazo_actual.get()
+
+
+@contextmanager
+def con_plazo(plazo):
+    """Activa `plazo` para todo lo que se ejecute dentro del bloque"""
+    token = _plazo_actual.set(plazo)
+    try:
+        yield plazo
+    finally:
+        _plazo_actual.reset(token)
+
+
+def timeout_para(maximo, minimo=0.5, usar_reserva=False):
+    """
+    Timeout para la próxima llamada: el menor entre `maximo` y lo que
+    queda del plazo actual. Sin plazo activo (crons), retorna `maximo`.
+    Lanza PlazoAgotado si quedan menos de `minimo` segundos.
+    """
+    plazo = _plazo_actual.get()
+    if plazo is None:
+        return maximo
+
+    restante = plazo.restante(usar_reserva)
+    if restante < minimo:
+        raise PlazoAgotado(f'quedan {restante:.1f}s')
+    return min(maximo, restante)
+
+
+def es_error_de_plazo(error):
+    """
+    True si el error se debe al plazo: PlazoAgotado o cualquier falla
+    (timeout de requests/OpenAI/MongoDB) con el plazo ya vencido.
+    """
+    if isinstance(error, PlazoAgotado):
+        return True
+    plazo = _plazo_actual.get()
+    return plazo is not None and plazo.agotado()
+
+
+def enviar_con_plazo(executor, funcion, *args, **kwargs):
+    """
+    executor.submit que conserva el plazo (y el timeout de MongoDB)
+    del hilo actual dentro del hilo del executor.
+    """
+    contexto = contextvars.copy_context()
+    return executor.submit(contexto.run, funcion, *args, **kwargs)
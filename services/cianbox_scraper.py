@@ -7,6 +7,8 @@ import time
 import requests
 from bs4 import BeautifulSoup
 
+from plazos import timeout_para
+
 # ============================================
 # CONFIGURACIÓN
 # ============================================
@@ -48,7 +50,7 @@ def cianbox_login():
                 'Content-Type': 'application/x-www-form-urlencoded'
             },
             allow_redirects=False,
-            timeout=30
+            timeout=timeout_para(30)
         )
         
         # Guardar cookies si el login fue exitoso
@@ -109,7 +111,7 @@ def cianbox_post(sec, extra_params=None):
             headers={
                 'Content-Type': 'application/x-www-form-urlencoded'
             },
-            timeout=60
+            timeout=timeout_para(60)
         )
         
         if response.status_code == 200:
@@ -3,8 +3,14 @@ Servicio de Cianbox - Integración con API REST
 Maneja autenticación, renovación de tokens y consultas
 """
 import os
+import random
+import threading
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+
+from plazos import timeout_para
 
 # ============================================
 # CONFIGURACIÓN
@@ -18,6 +24,15 @@ _tokens = {
     'expires_at': 0  # Timestamp de cuando vence
 }
 
+# Para que varios hilos no renueven el mismo token a la vez
+_lock_token = threading.Lock()
+
+# Descarga paginada (sincronización de clientes)
+PAGINAS_EN_PARALELO = int(os.environ.get('CIANBOX_PAGINAS_EN_PARALELO', 4))
+REINTENTOS_PAGINA = int(os.environ.get('CIANBOX_REINTENTOS_PAGINA', 3))
+ESPERA_REINTENTO_SEGUNDOS = float(
+    os.environ.get('CIANBOX_ESPERA_REINTENTO_SEGUNDOS', 1))
+
 # ============================================
 # AUTENTICACIÓN
 # ============================================
@@ -43,7 +58,7 @@ def obtener_token():
                 'user': user,
                 'password': password
             },
-            timeout=30
+            timeout=timeout_para(30)
         )
         
         if response.status_code == 200:
@@ -81,7 +96,7 @@ def renovar_token():
             json={
                 'refresh_token': _tokens['refresh_token']
             },
-            timeout=30
+            timeout=timeout_para(30)
         )
         
         if response.status_code == 200:
@@ -142,7 +157,7 @@ def _hacer_request(endpoint, params=None):
         response = requests.get(
             f'{CIANBOX_BASE_URL}/{endpoint}',
             params=params,
-            timeout=30
+            timeout=timeout_para(30)
         )
         
         data = response.json()
@@ -155,7 +170,7 @@ def _hacer_request(endpoint, params=None):
                 response = requests.get(
                     f'{CIANBOX_BASE_URL}/{endpoint}',
                     params=params,
-                    timeout=30
+                    timeout=timeout_para(30)
                 )
                 data = response.json()
         
@@ -170,6 +185,109 @@ def _hacer_request(endpoint, params=None):
         return None
 
 
+def _pedir_pagina(sesion, endpoint, params, pagina):
+    """
+    Pide una página, con reintentos y espera exponencial (con jitter).
+    Retorna la lista del body; lanza RuntimeError si fallan todos los intentos.
+    """
+    error = None
+    for intento in range(REINTENTOS_PAGINA + 1):
+        if intento:
+            espera = ESPERA_REINTENTO_SEGUNDOS * 2**(intento - 1) * random.uniform(0.5, 1.5)
+            print(f'⚠️ Cianbox: {endpoint} página {pagina} falló ({error}), '
+                  f'reintento {intento} en {espera:.1f}s')
+            time.sleep(espera)
+
+        token = get_token()
+        if not token:
+            error = 'sin token'
+            continue
+
+        try:
+            response = sesion.get(f'{CIANBOX_BASE_URL}/{endpoint}',
+                                  params=dict(params,
+                                              access_token=token,
+                                              page=pagina),
+                                  timeout=timeout_para(30))
+            if response.status_code != 200:
+                error = f'HTTP {response.status_code}'
+                continue
+
+            data = response.json()
+            if data.get('status') == 'ok':
+                return data.get('body') or []
+
+            error = data.get('message', 'Error desconocido')
+            if 'token' in error.lower():
+                with _lock_token:
+                    # Otro hilo pudo haberlo renovado mientras tanto
+                    if _tokens['access_token'] == token:
+                        renovar_token()
+
+        except Exception as e:
+            error = str(e)
+
+    raise RuntimeError(f'{endpoint} página {pagina}: {error}')
+
+
+def descargar_paginas(endpoint, params=None, por_pagina=100, concurrencia=None):
+    """
+    Descarga TODAS las páginas de `endpoint` (ej: 'clientes'), con hasta
+    `concurrencia` páginas pedidas a la vez sobre una sesión con
+    keep-alive. Termina en la primera página vacía, sin límite de páginas.
+
+    Returns:
+        (items en el orden de las páginas, cantidad de páginas con datos)
+    Lanza RuntimeError si una página falla después de los reintentos
+    (mejor no sincronizar que guardar un listado cortado).
+    """
+    concurrencia = concurrencia or PAGINAS_EN_PARALELO
+    params = dict(params or {}, limit=por_pagina)
+
+    resultados = {}
+    vacia = None  # primera página vacía
+    siguiente = 1
+
+    with requests.Session() as sesion, ThreadPoolExecutor(
+            max_workers=concurrencia,
+            thread_name_prefix='cianbox') as executor:
+        sesion.mount('https://', HTTPAdapter(pool_maxsize=concurrencia))
+        pendientes = {}
+
+        def pedir_siguiente():
+            nonlocal siguiente
+            futuro = executor.submit(_pedir_pagina, sesion, endpoint, params,
+                                     siguiente)
+            pendientes[futuro] = siguiente
+            siguiente += 1
+
+        for _ in range(concurrencia):
+            pedir_siguiente()
+
+        while pendientes:
+            listos, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                pagina = pendientes.pop(futuro)
+                try:
+                    items = futuro.result()
+                except Exception:
+                    for otro in pendientes:
+                        otro.cancel()
+                    raise
+
+                if not items:
+                    vacia = pagina if vacia is None else min(vacia, pagina)
+                    continue
+
+                resultados[pagina] = items
+                print(f'📥 Cianbox: {endpoint} página {pagina}: {len(items)}')
+                if vacia is None:
+                    pedir_siguiente()
+
+    paginas = sorted(pagina for pagina in resultados if pagina < vacia)
+    return [item for pagina in paginas for item in resultados[pagina]], len(paginas)
+
+
 def buscar_cliente_por_celular(celular):
     """
     Busca un cliente en Cianbox por número de celular.